@@ -1,12 +1,69 @@
 import importlib.abc
 import importlib.machinery
+import importlib.util
+import marshal
 import os
 import sys
+import tempfile
 import makrell.makrellpy.compiler as mrpy_compiler
 from importlib.metadata import version
 
 __version__ = version("makrell")
 
+# Flags of hash-based pycs that are checked against the source, see PEP 552
+_checked_hash_flags = 0b11
+
+
+def _source_hash(source: bytes) -> bytes:
+    # A new version of Makrell may compile the same source differently
+    return importlib.util.source_hash(__version__.encode() + b"\0" + source)
+
+
+def _pyc_is_current(data: bytes, source_hash: bytes) -> bool:
+    return (data[:4] == importlib.util.MAGIC_NUMBER
+            and int.from_bytes(data[4:8], 'little') == _checked_hash_flags
+            and data[8:16] == source_hash)
+
+
+def _pyc_data(code, source_hash: bytes) -> bytes:
+    header = importlib.util.MAGIC_NUMBER + _checked_hash_flags.to_bytes(4, 'little') + source_hash
+    return header + marshal.dumps(code)
+
+
+def _bytecode_path(source_path: str) -> str:
+    """The bytecode file for a .mr file, such as __pycache__/foo.cpython-311.opt-mr.pyc.
+
+    The opt-mr tag keeps it apart from that of a foo.py in the same directory.
+    """
+    return importlib.util.cache_from_source(source_path, optimization="mr")
+
+
+def _write_atomic(path: str, data: bytes):
+    """Write a file so that concurrent readers never see it partially written"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _compile_source(source: bytes | str, path: str):
+    """Compile Makrell source, and tell if the code may be kept in a bytecode file.
+
+    Code that imports macros with importm may not, since they come from other
+    modules and the bytecode file is only checked against this one's source.
+    """
+    if isinstance(source, bytes):
+        source = importlib.util.decode_source(source)
+    cc = mrpy_compiler.CompilerContext(mrpy_compiler.compile_mr)
+    m = mrpy_compiler.src_to_module(source, cc=cc)
+    return mrpy_compiler.compile_py(m, path, "exec"), not cc.mr_meta_imports
+
+
 class MakrellLoader(importlib.abc.SourceLoader):
 
     def __init__(self, fullname, path):
@@ -16,56 +73,124 @@ class MakrellLoader(importlib.abc.SourceLoader):
     def get_filename(self, fullname):
         return self.path    
     
-    def get_data(self, path: str):
-        if path.endswith(".pyc"):
-            with open(path, "rb") as f:
-                data = f.read()
-            return data
-        with open(path, "r", encoding='utf-8') as f:
-            data = f.read()
-        return data
+    def get_data(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def path_stats(self, path: str) -> dict:
+        st = os.stat(path)
+        return {'mtime': st.st_mtime, 'size': st.st_size}
+
+    def set_data(self, path: str, data: bytes):
+        """Write a bytecode file atomically, ignoring failures as the stdlib loaders do"""
+        try:
+            _write_atomic(path, data)
+        except OSError:
+            pass
+
+    def get_code(self, fullname):
+        """Compile the module, using a bytecode file in __pycache__ if it is up to date.
+
+        Bytecode files are hash-based (PEP 552), keyed on the source and the
+        Makrell version, since recompiling costs far more than hashing the source.
+        None is written for modules that use importm.
+        """
+        source_path = self.get_filename(fullname)
+        source = self.get_data(source_path)
+        source_hash = _source_hash(source)
+        try:
+            bytecode_path = _bytecode_path(source_path)
+        except NotImplementedError:
+            bytecode_path = None
+
+        if bytecode_path is not None:
+            try:
+                data = self.get_data(bytecode_path)
+            except OSError:
+                pass
+            else:
+                if _pyc_is_current(data, source_hash):
+                    try:
+                        return marshal.loads(memoryview(data)[16:])
+                    except (EOFError, ValueError, TypeError):
+                        pass
+
+        code, cacheable = _compile_source(source, source_path)
+        if cacheable and bytecode_path is not None and not sys.dont_write_bytecode:
+            self.set_data(bytecode_path, _pyc_data(code, source_hash))
+        return code
 
     def source_to_code(self, data, path, _optimize=-1):
-        m = mrpy_compiler.src_to_module(data)
-        c = compile(m, filename=path, mode="exec")
-        return c
+        return _compile_source(data, path)[0]
 
 
 class MakrellFinder():
+    """Finds .mr modules, and packages with an __init__.mr.
+
+    Like importlib.machinery.FileFinder, it keeps a listing of each directory it
+    searches, which is read again when the directory's mtime changes, or after
+    importlib.invalidate_caches(). Since the finder is on sys.meta_path, it is
+    asked about every import in the process, and most of them are answered
+    with a stat per directory.
+    """
+
+    def __init__(self):
+        # directory -> (mtime_ns, names in it)
+        self._listings: dict[str, tuple[int, frozenset[str]]] = {}
+        here_dir = os.path.dirname(os.path.abspath(__file__))
+        self._root_dir = os.path.join(here_dir, "..")
+
+    def invalidate_caches(self):
+        self._listings.clear()
+
+    def _listing(self, directory: str) -> frozenset[str]:
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return frozenset()
+        cached = self._listings.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            names = frozenset()
+        self._listings[directory] = (mtime, names)
+        return names
 
     def find_spec(self, fullname, path, target=None):
         if path is None:
-            path = []
-        if not isinstance(path, list):
-            path = [path]
-        path.append(os.getcwd())
-        here_dir = os.path.dirname(os.path.abspath(__file__))
-        root_dir = os.path.join(here_dir, "..")
-        path.append(root_dir)
-
-        for entry in path:
-            if os.path.isdir(entry):
-                fullname_parts = fullname.split('.')
-                fullname_path = os.path.join(*fullname_parts)
-                entry_path = os.path.join(entry, fullname_path)
-                is_dir = os.path.isdir(entry_path)
-                if is_dir:
+            entries = []
+        elif isinstance(path, str):
+            entries = [path]
+        else:
+            entries = list(path)
+        entries.append(os.getcwd())
+        entries.append(self._root_dir)
+
+        fullname_parts = fullname.split('.')
+        name = fullname_parts[-1]
+        for entry in entries:
+            parent_path = os.path.join(entry, *fullname_parts[:-1])
+            names = self._listing(parent_path)
+            if name in names:
+                entry_path = os.path.join(parent_path, name)
+                package_names = self._listing(entry_path)
+                if '__init__.mr' in package_names:
                     mr_init = os.path.join(entry_path, '__init__.mr')
-                    if os.path.exists(mr_init):
-                        return importlib.machinery.ModuleSpec(
-                            fullname, MakrellLoader(fullname, mr_init),
-                            origin=entry_path, is_package=True)
+                    return importlib.machinery.ModuleSpec(
+                        fullname, MakrellLoader(fullname, mr_init),
+                        origin=entry_path, is_package=True)
+                if '__init__.py' in package_names:
                     py_init = os.path.join(entry_path, '__init__.py')
-                    if os.path.exists(py_init):
-                        return importlib.machinery.ModuleSpec(
-                            fullname, MakrellLoader(fullname, py_init),
-                            origin=py_init)
-                filename = entry_path + '.mr'
-                if os.path.exists(filename):
-                    ms = importlib.machinery.ModuleSpec(
-                        fullname, MakrellLoader(fullname, filename),
-                        origin=filename)
-                    return ms
+                    return importlib.machinery.ModuleSpec(
+                        fullname, MakrellLoader(fullname, py_init),
+                        origin=py_init)
+            if name + '.mr' in names:
+                filename = os.path.join(parent_path, name + '.mr')
+                return importlib.machinery.ModuleSpec(
+                    fullname, MakrellLoader(fullname, filename),
+                    origin=filename)
 
 
 sys.meta_path.append(MakrellFinder())
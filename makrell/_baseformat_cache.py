@@ -0,0 +1,186 @@
+"""On-disk cache of parsed base format trees.
+
+A tree is stored in pre-order as the kind of each node and a number, which is
+the length of a token or the child count of a bracket. Base format keeps every
+token but the brackets themselves, which are one character each, so the nodes
+cover the source without gaps and their offsets follow from the lengths alone.
+Trees parsed without trivia do have gaps, which are stored as pseudo-nodes of
+their length, and the length of every bracket is stored as well so that gaps
+before a closing bracket need no entry. Strings and numbers also get their
+suffix length. Token text is sliced from the source again on loading. Files are
+named by a hash of the source, so a changed source never hits a stale entry.
+"""
+
+from array import array
+from hashlib import blake2b
+import os
+import struct
+import sys
+import tempfile
+from makrell.ast import (
+    Comment, CurlyBrackets, Identifier, LineIndex, Node, Number, Operator, RoundBrackets, SquareBrackets,
+    String, Unknown, Whitespace, pack_span)
+
+# Bump when the encoding changes
+format_version = 2
+
+node_types = [Whitespace, Comment, Identifier, String, Number, Operator, Unknown,
+              RoundBrackets, SquareBrackets, CurlyBrackets]
+_kinds = {nt: i for i, nt in enumerate(node_types)}
+_first_bracket_kind = _kinds[RoundBrackets]
+_identifier_kind = _kinds[Identifier]
+_operator_kind = _kinds[Operator]
+_string_kind = _kinds[String]
+_number_kind = _kinds[Number]
+_gap_kind = 255
+
+_magic = b"MBF\x00"
+_header = struct.Struct("<4sqqq")
+
+
+def cache_path(src: str, cache_dir: str, keep_trivia: bool = True) -> str:
+    h = blake2b(src.encode("utf-8"), digest_size=20)
+    h.update(f"{format_version} {sys.byteorder} {keep_trivia}".encode())
+    return os.path.join(cache_dir, h.hexdigest() + ".mbf")
+
+
+def encode(nodes: list[Node]) -> bytes:
+    """Encode a base format tree. Raises ValueError if its nodes are not in source order."""
+    kinds = array('B')
+    values = array('I')
+    suffix_lengths = array('I')
+    bracket_lengths = array('I')
+    pos = 0
+    # iterators over the children of the open brackets, with the brackets' ends
+    stack = [(iter(nodes), 0)]
+    while stack:
+        n = next(stack[-1][0], None)
+        if n is None:
+            pos = stack.pop()[1]
+            continue
+        kind = _kinds[type(n)]
+        if n._start != pos:
+            if n._start < pos:
+                raise ValueError(f"Overlapping nodes in base format tree at {pos}")
+            kinds.append(_gap_kind)
+            values.append(n._start - pos)
+            pos = n._start
+        kinds.append(kind)
+        if kind >= _first_bracket_kind:
+            values.append(len(n.nodes))  # type: ignore
+            bracket_lengths.append(n._end - n._start)
+            stack.append((iter(n.nodes), n._end))  # type: ignore
+            pos += 1
+        else:
+            values.append(n._end - n._start)
+            pos = n._end
+            if kind == _string_kind or kind == _number_kind:
+                suffix_lengths.append(len(n.suffix or ""))  # type: ignore
+    return b"".join([_header.pack(_magic, len(kinds), len(suffix_lengths), len(bracket_lengths)),
+                     kinds.tobytes(), values.tobytes(), suffix_lengths.tobytes(), bracket_lengths.tobytes()])
+
+
+def decode(src: str, data: bytes, keep_trivia: bool = True) -> list[Node]:
+    magic, count, suffix_count, bracket_count = _header.unpack_from(data)
+    if magic != _magic:
+        raise ValueError("Not a base format cache file")
+    pos = _header.size
+    kinds = array('B', data[pos:pos + count])
+    pos += count
+    values = array('I')
+    values.frombytes(data[pos:pos + values.itemsize * count])
+    pos += values.itemsize * count
+    suffix_lengths = array('I')
+    suffix_lengths.frombytes(data[pos:pos + suffix_lengths.itemsize * suffix_count])
+    pos += suffix_lengths.itemsize * suffix_count
+    bracket_lengths = array('I')
+    bracket_lengths.frombytes(data[pos:pos + bracket_lengths.itemsize * bracket_count])
+
+    lines = LineIndex.from_src(src)
+    types = node_types
+    intern = sys.intern
+    root: list[Node] = []
+    current = root
+    # open brackets, with their parent's child list and the number of children
+    # the parent still has to read
+    stack: list[tuple[Node, list[Node], int]] = []
+    remaining = -1
+    suffix_index = 0
+    bracket_index = 0
+    pos = 0
+
+    for i in range(count):
+        kind = kinds[i]
+        start = pos
+        if kind == _gap_kind:
+            pos += values[i]
+            continue
+        if kind >= _first_bracket_kind:
+            node = types[kind]([])
+            node._span = pack_span(start, start + bracket_lengths[bracket_index])
+            bracket_index += 1
+            pos += 1
+        else:
+            pos += values[i]
+            if kind == _string_kind or kind == _number_kind:
+                split = pos - suffix_lengths[suffix_index]
+                suffix_index += 1
+                node = types[kind](src[start:split], src[split:pos])
+            elif kind == _identifier_kind or kind == _operator_kind:
+                node = types[kind](intern(src[start:pos]))
+            else:
+                node = types[kind](src[start:pos])
+            node._span = pack_span(start, pos)
+        node._lines = lines
+        current.append(node)
+        remaining -= 1
+
+        if kind >= _first_bracket_kind:
+            stack.append((node, current, remaining))
+            current = node.nodes  # type: ignore
+            remaining = values[i]
+        while remaining == 0:
+            bracket, current, remaining = stack.pop()
+            pos = bracket._end
+            if keep_trivia:
+                bracket._original_nodes = list(bracket.nodes)  # type: ignore
+    if stack or pos > len(src) or (keep_trivia and pos != len(src)):
+        raise ValueError("Base format cache file does not match source")
+    return root
+
+
+def load(src: str, cache_dir: str, keep_trivia: bool = True) -> list[Node] | None:
+    """The cached tree for src, or None if there is none or it can't be read"""
+    try:
+        with open(cache_path(src, cache_dir, keep_trivia), 'rb') as f:
+            data = f.read()
+        return decode(src, data, keep_trivia)
+    except (OSError, ValueError, struct.error, IndexError):
+        return None
+
+
+def store(src: str, nodes: list[Node], cache_dir: str, keep_trivia: bool = True):
+    """Write the tree for src to the cache, atomically so concurrent readers never see partial files.
+
+    Nothing is stored if the cache directory can't be written to.
+    """
+    try:
+        data = encode(nodes)
+    except (ValueError, OverflowError):
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    except OSError:
+        return  # an unwritable cache just isn't used
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path(src, cache_dir, keep_trivia))
+    except BaseException as e:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        if not isinstance(e, OSError):
+            raise
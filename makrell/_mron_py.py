@@ -1,9 +1,10 @@
 import re
 from typing import Any
-from makrell.ast import Identifier, Number, Sequence, SquareBrackets, CurlyBrackets, Node, String
+from makrell.ast import Identifier, Number, Sequence, SquareBrackets, CurlyBrackets, Node, String, fold_tree
 from makrell.makrellpy.compiler import eval_nodes
 import makrell.baseformat as mp
-from makrell.tokeniser import regular
+from makrell.tokeniser import (
+    KIND_IDENTIFIER, KIND_LPAR, KIND_NUMBER, KIND_RPAR, KIND_STRING, TokenStream, src_to_token_stream, token_kinds)
 from makrell.parsing import get_identifier, python_value, pairwise
 
 
@@ -38,24 +39,34 @@ rx_int = re.compile(r'^-?\d+$')
 
 
 def parse_token(n: Node, allow_exec: bool = False) -> Any:
-    if isinstance(n, Identifier):
-        return n.value
-    elif isinstance(n, String):
-        return python_value(n)
-    elif isinstance(n, Number):
-        return python_value(n)
-    elif isinstance(n, CurlyBrackets):
-        if allow_exec and len(n.nodes) >= 2 and get_identifier(n.nodes[0], "$"):
-            r = eval_nodes(mp.operator_parse(n.nodes[1:])[0])
-            return r
-        return parse_token_pairs(regular(n.nodes))
-    elif isinstance(n, SquareBrackets):
-        return [parse_token(ni) for ni in regular(n.nodes)]
-    elif isinstance(n, Sequence):
-        return parse_token_pairs(regular(n.nodes))
-    else:
-        raise Exception(f"Unknown node type: {type(n)}")
-    
+    # Only n itself is evaluated as {$ ...}, with allow_exec. Nested in it, {$ ...} is an object.
+    def is_exec(x: Node) -> bool:
+        return (allow_exec and x is n and isinstance(x, CurlyBrackets) and len(x.regular_nodes) >= 2
+                and get_identifier(x.regular_nodes[0], "$") is not None)
+
+    def children(x: Node) -> list[Node] | None:
+        if isinstance(x, Sequence) and not is_exec(x):
+            return x.regular_nodes
+        return None
+
+    def combine(x: Node, values: list[Any]) -> Any:
+        if isinstance(x, Identifier):
+            return x.value
+        elif isinstance(x, String):
+            return python_value(x)
+        elif isinstance(x, Number):
+            return python_value(x)
+        elif isinstance(x, CurlyBrackets) and is_exec(x):
+            return eval_nodes(mp.operator_parse(x.regular_nodes[1:])[0])
+        elif isinstance(x, SquareBrackets):
+            return values
+        elif isinstance(x, Sequence):
+            return MronObject(dict(pairwise(values)))
+        else:
+            raise Exception(f"Unknown node type: {type(x)}")
+
+    return fold_tree(n, children, combine)
+
 
 def parse_token_pairs(ns: list[Node], allow_exec: bool = False) -> MronObject:
     pairs = pairwise(ns)
@@ -73,17 +84,84 @@ def parse_nodes(ns: list[Node], allow_exec: bool = False) -> MronObject | Any:
         return parse_token_pairs(ns, allow_exec)
 
 
-def parse_src(text: str, allow_exec: bool = False) -> MronObject | Any:
-    tokens = regular(mp.src_to_tokens(text))
-    ns = mp.nodes_to_baseformat(tokens)
-    if len(ns) == 0:
+def _closing_index(ts: TokenStream, i: int) -> int | None:
+    """Index of the bracket closing the one opened at index i, None if it isn't closed"""
+    depth = 0
+    kinds = ts.kinds
+    for j in range(i, len(kinds)):
+        if kinds[j] == KIND_LPAR:
+            depth += 1
+        elif kinds[j] == KIND_RPAR:
+            depth -= 1
+            if depth == 0:
+                return j
+    return None
+
+
+def _bracket_value(bracket: str, items: list[Any]) -> Any:
+    if bracket == "[":
+        return items
+    return MronObject({k: v for k, v in pairwise(items)})
+
+
+_closing_brackets = {"(": ")", "[": "]", "{": "}"}
+
+
+def parse_token_stream(ts: TokenStream, allow_exec: bool = False) -> MronObject | Any:
+    """Parse a regular token stream directly, without building a node tree.
+
+    As with a node tree, only root level {$ ...} is evaluated, with allow_exec,
+    and a root level bracket that isn't closed is left out with all in it.
+    """
+    src = ts.src
+    kinds = ts.kinds
+    starts = ts.starts
+    stack: list[tuple[str, list[Any]]] = [("", [])]
+    items = stack[-1][1]
+    i = 0
+    while i < len(kinds):
+        kind = kinds[i]
+        if kind == KIND_IDENTIFIER:
+            items.append(ts.value(i))
+        elif kind == KIND_STRING or kind == KIND_NUMBER:
+            items.append(python_value(ts[i]))
+        elif kind == KIND_LPAR:
+            bracket = src[starts[i]]
+            if (allow_exec and len(stack) == 1 and bracket == "{" and i + 1 < len(kinds)
+                    and kinds[i + 1] == KIND_IDENTIFIER and ts.value(i + 1) == "$"):
+                j = _closing_index(ts, i)
+                if j is None:
+                    break
+                n = mp.nodes_to_baseformat([ts[k] for k in range(i, j + 1)])[0]
+                items.append(parse_token(n, allow_exec))
+                i = j
+            else:
+                stack.append((bracket, []))
+                items = stack[-1][1]
+        elif kind == KIND_RPAR:
+            bracket = src[starts[i]]
+            if len(stack) == 1 or _closing_brackets[stack[-1][0]] != bracket:
+                raise mp.ParseError(f"Unmatched closing bracket {bracket} at {ts[i].pos_str()}")
+            opening, values = stack.pop()
+            items = stack[-1][1]
+            items.append(_bracket_value(opening, values))
+        else:
+            raise Exception(f"Unknown node type: {token_kinds[kind]}")
+        i += 1
+
+    items = stack[0][1]
+    if len(items) == 0:
         return None
-    if len(ns) == 1:
-        v = parse_token(ns[0], allow_exec)
-        return v
-    if len(ns) % 2 == 0:
-        return parse_token_pairs(ns, allow_exec)
-    raise Exception(f"Illegal number ({len(ns)}) of root level expressions")
+    if len(items) == 1:
+        return items[0]
+    if len(items) % 2 == 0:
+        return MronObject({k: v for k, v in pairwise(items)})
+    raise Exception(f"Illegal number ({len(items)}) of root level expressions")
+
+
+def parse_src(text: str, allow_exec: bool = False) -> MronObject | Any:
+    ts = src_to_token_stream(text, keep_trivia=False).regular()
+    return parse_token_stream(ts, allow_exec)
 
 
 def parse_file(path: str, allow_exec: bool = False) -> MronObject | Any:
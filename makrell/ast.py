@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from dataclasses import dataclass, field
 import typing as t
 
@@ -21,22 +22,131 @@ def not_found_error(expected: 'Node | type', val: str | None, found: 'Node') ->
     return ParseError(f"Expected {expected_descr} at {pos}, found {found_descr}")
 
 
-@dataclass
+class LineIndex:
+    """Start offsets of the lines of a source text.
+
+    Nodes store absolute source offsets, and line and column numbers are looked
+    up here only when they are needed. An index may cover just a part of a
+    source, starting at line `first_line`.
+    """
+
+    def __init__(self, starts: list[int], first_line: int = 1):
+        self.starts = starts
+        self.first_line = first_line
+
+    @classmethod
+    def from_src(cls, src: str | bytes, offset: int = 0, line: int = 1, line_start: int | None = None) -> 'LineIndex':
+        """Index src, whose first character is at `offset` on line `line`, which starts at `line_start`"""
+        starts = [offset if line_start is None else line_start]
+        find = src.find
+        newline = "\n" if isinstance(src, str) else b"\n"
+        i = find(newline)
+        while i >= 0:
+            starts.append(offset + i + 1)
+            i = find(newline, i + 1)
+        return cls(starts, line)
+
+    def line_column(self, offset: int) -> tuple[int, int]:
+        """1-based line and column of an offset"""
+        i = bisect_right(self.starts, offset) - 1
+        if i < 0:
+            i = 0
+        return self.first_line + i, offset - self.starts[i] + 1
+
+    def offset(self, line: int, column: int) -> int:
+        """Offset of a 1-based line and column"""
+        return self.starts[line - self.first_line] + column - 1
+
+    def update(self, src: str, start: int, end: int, new_end: int):
+        """Update in place after the old text at [start, end) was replaced by src[start:new_end]"""
+        delta = new_end - end
+        starts = self.starts
+        lo = bisect_right(starts, start)
+        hi = bisect_right(starts, end)
+        added = []
+        i = src.find("\n", start, new_end)
+        while i >= 0:
+            added.append(i + 1)
+            i = src.find("\n", i + 1, new_end)
+        starts[lo:] = added + [s + delta for s in starts[hi:]]
+
+
+# A node's start and end offsets are packed into one int, _span. The low span_bits
+# bits hold the end + 1 and the bits above them the start + 1, so 0 is unknown.
+span_bits = 40
+_end_mask = (1 << span_bits) - 1
+
+
+def pack_span(start: int, end: int) -> int:
+    return ((start + 1) << span_bits) | (end + 1)
+
+
+@dataclass(slots=True)
 class Node:
-    _start_line: int = field(default=0, init=False)
-    _start_column: int = field(default=0, init=False)
-    _end_line: int = field(default=0, init=False)
-    _end_column: int = field(default=0, init=False)
+    _span: int = field(default=0, init=False, repr=False)
+    _lines: LineIndex | None = field(default=None, init=False, repr=False, compare=False)
     _type: t.Any = field(default=t.Any, init=False)
 
+    @property
+    def _start(self) -> int:
+        return (self._span >> span_bits) - 1
+
+    @_start.setter
+    def _start(self, start: int):
+        self._span = ((start + 1) << span_bits) | (self._span & _end_mask)
+
+    @property
+    def _end(self) -> int:
+        return (self._span & _end_mask) - 1
+
+    @_end.setter
+    def _end(self, end: int):
+        self._span = (self._span & ~_end_mask) | (end + 1)
+
+    @property
+    def _start_line(self) -> int:
+        return self.start_pos()[0]
+
+    @property
+    def _start_column(self) -> int:
+        return self.start_pos()[1]
+
+    @property
+    def _end_line(self) -> int:
+        return self.end_pos()[0]
+
+    @property
+    def _end_column(self) -> int:
+        return self.end_pos()[1]
+
+    def start_pos(self) -> tuple[int, int]:
+        """Line and column of the start, (0, 0) if unknown"""
+        if self._lines is None or self._start < 0:
+            return 0, 0
+        return self._lines.line_column(self._start)
+
+    def end_pos(self) -> tuple[int, int]:
+        """Line and column just after the end, (0, 0) if unknown"""
+        if self._lines is None or self._end < 0:
+            return 0, 0
+        return self._lines.line_column(self._end)
+
+    def set_span(self, first: 'Node', last: 'Node | None' = None):
+        """Set the position to run from the start of first to the end of last"""
+        last = last or first
+        self._lines = first._lines or last._lines
+        end = last._end if last._lines is self._lines else -1
+        self._span = pack_span(first._start, end)
+
     def pos_str(self) -> str:
-        return f"{self._start_line}:{self._start_column}"
+        line, column = self.start_pos()
+        return f"{line}:{column}"
     
     def to_code(self, indent: int = 0):
         return " " * indent
     
 
-@dataclass
+@dataclass(slots=True)
 class Comment(Node):
     value: str
 
@@ -47,7 +157,7 @@ class Comment(Node):
         return f"CO:{self.value}"
 
 
-@dataclass
+@dataclass(slots=True)
 class Whitespace(Node):
     value: str
 
@@ -58,7 +168,7 @@ class Whitespace(Node):
         return "WS"
 
 
-@dataclass
+@dataclass(slots=True)
 class Unknown(Node):
     value: str
 
@@ -66,7 +176,11 @@ class Unknown(Node):
         return self.value
 
 
-@dataclass
+# Tokens that carry no meaning, and are dropped by regular()
+trivia_types = (Comment, Whitespace, Unknown)
+
+
+@dataclass(slots=True)
 class MacroPlaceholder(Node):
     value: str
 
@@ -74,7 +188,7 @@ class MacroPlaceholder(Node):
         return self.value
 
 
-@dataclass
+@dataclass(slots=True)
 class Identifier(Node):
     value: str
 
@@ -95,7 +209,7 @@ class Identifier(Node):
         return self.value
 
 
-@dataclass()
+@dataclass(slots=True)
 class String(Node):
     value: str
     suffix: str | None = None
@@ -110,7 +224,7 @@ class String(Node):
         return self.value + (self.suffix or "")
 
 
-@dataclass
+@dataclass(slots=True)
 class Number(Node):
     value: str
     suffix: str | None = None
@@ -125,7 +239,7 @@ class Number(Node):
         return self.value + (self.suffix or "")
 
 
-@dataclass
+@dataclass(slots=True)
 class Operator(Node):
     value: str
 
@@ -138,7 +252,7 @@ class Operator(Node):
     def to_code(self, indent: int):
         return self.value
 
-@dataclass
+@dataclass(slots=True)
 class BinOp(Node):
     left: Node
     op: str
@@ -155,25 +269,50 @@ class BinOp(Node):
                 " " + self.op + " " + self.right.to_code(indent) + ")")
 
 
-@dataclass
+@dataclass(slots=True)
 class LPar(Node):
     value: str
 
 
-@dataclass
+@dataclass(slots=True)
 class RPar(Node):
     value: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Sequence(Node):
     """Abstract base class"""
     nodes: t.List[Node]
 
     _original_nodes: t.List[Node] = field(default_factory=list, init=False)
+    _regular: tuple | None = field(default=None, init=False, repr=False, compare=False)
+    _operator_parsed: tuple | None = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def regular_nodes(self) -> t.List[Node]:
+        """The child nodes without whitespace, comments and unknown tokens.
+
+        The list is cached and shared, so it must not be modified. It is computed
+        again if nodes is replaced by another list or changes length. After
+        replacing an item of nodes in place, call invalidate.
+        """
+        nodes = self.nodes
+        cached = self._regular
+        if cached is None or cached[0] is not nodes or cached[1] != len(nodes):
+            regular = [n for n in nodes if not isinstance(n, trivia_types)]
+            self._regular = cached = (nodes, len(nodes), regular)
+        return cached[2]
+
+    def invalidate(self):
+        """Drop the cached regular nodes and operator parse, after nodes was modified in place"""
+        self._regular = None
+        self._operator_parsed = None
 
     @property
     def original_nodes_str(self) -> str:
+        if not self._original_nodes and self.nodes:
+            # parsed without trivia, so the spacing is not known
+            return " ".join([str(n) for n in self.nodes])
         return "".join([str(n) for n in self._original_nodes])
     
     def __str__(self):
@@ -205,7 +344,7 @@ class Sequence(Node):
         return indent * " " + " ".join([n.to_code(indent) for n in self.nodes])
 
 
-@dataclass
+@dataclass(slots=True)
 class NoBrackets(Sequence):
 
     def __str__(self):
@@ -213,7 +352,7 @@ class NoBrackets(Sequence):
         return ''.join(ns)
 
 
-@dataclass
+@dataclass(slots=True)
 class CurlyBrackets(Sequence):
 
     def __str__(self):
@@ -226,7 +365,7 @@ class CurlyBrackets(Sequence):
         return indent * " " + "{" + " ".join([n.to_code(indent) for n in self.nodes]) + "}"
 
 
-@dataclass
+@dataclass(slots=True)
 class RoundBrackets(Sequence):
 
     def __str__(self):
@@ -239,7 +378,7 @@ class RoundBrackets(Sequence):
         return indent * " " + "(" + " ".join([n.to_code(indent) for n in self.nodes]) + ")"
 
 
-@dataclass
+@dataclass(slots=True)
 class SquareBrackets(Sequence):
 
     def __str__(self):
@@ -291,6 +430,35 @@ def node_name(n: Node | type) -> str:
             return nname
 
 
+def fold_tree(root: t.Any, children: t.Callable[[t.Any], t.Iterable | None],
+              combine: t.Callable[[t.Any, list], t.Any]) -> t.Any:
+    """Compute a value for a tree bottom-up, without recursion.
+
+    children(x) gives the children of x, or None if x is a leaf, and
+    combine(x, values) gives the value of x from the values of its children,
+    which is an empty list for leaves. The open nodes are kept on an explicit
+    stack, so the depth of the tree is limited only by memory.
+    """
+    kids = children(root)
+    if kids is None:
+        return combine(root, [])
+    stack = [(root, iter(kids), [])]
+    while True:
+        node, it, values = stack[-1]
+        for child in it:
+            kids = children(child)
+            if kids is not None:
+                stack.append((child, iter(kids), []))
+                break
+            values.append(combine(child, []))
+        else:
+            stack.pop()
+            value = combine(node, values)
+            if not stack:
+                return value
+            stack[-1][2].append(value)
+
+
 def dump(n: Node, indent: int = 4, include_attributes: bool = False) -> str:
     
     def d(dn: Node, current_indent: int) -> str:
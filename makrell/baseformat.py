@@ -1,11 +1,16 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
 from enum import Enum
+from itertools import chain
 import os
 import typing as t
+import regex
 from makrell.ast import (
-    BinOp, LPar, Node, Operator, RPar,
-    RoundBrackets, Sequence, SquareBrackets, CurlyBrackets, String)
-from makrell.parsing import Diagnostics, ErrorCodes, flatten, get_identifier, get_string
-from makrell.tokeniser import regular, src_to_tokens
+    BinOp, LineIndex, LPar, Node, Operator, RPar, span_bits, trivia_types,
+    RoundBrackets, Sequence, SquareBrackets, CurlyBrackets, String, fold_tree)
+from makrell import _baseformat_cache
+from makrell.parsing import Diagnostics, ErrorCodes, deescape, get_identifier
+from makrell.tokeniser import file_to_token_stream, iter_tokens, regular, src_to_tokens
 
 
 class ParseError(Exception):
@@ -21,100 +26,136 @@ class Associativity(Enum):
     RIGHT = 1
 
 
-def e_string_to_baseformat(s: str) -> Node:
-    """Parse a string with e-string expressions"""
+def e_string_parts(n: String) -> list[str | Node]:
+    """Split an e-string into its literal text and its interpolated expressions.
+
+    Literal parts are returned as strings with escapes resolved, and each
+    expression as the round brackets node of its contents. All expressions are
+    parsed in one go, from a copy of the string where the literal text is blanked
+    out and the outer curly brackets of each expression are replaced with round
+    ones. The nodes therefore get their actual positions in the source.
+    """
     # parse "asd{2}qwe{2+3}zxc{2+{sum [3 5]}}{4}."
-    segments = []
+    s = n.value[1:-1]
+    segments = []  # (start, end, is expression)
     from_ = 0
-    i = 0
     nesting_level = 0
 
-    while i < len(s):
-        if s[i] == "{":
+    for i, ch in enumerate(s):
+        if ch == "{":
             if nesting_level == 0:
-                segments.append(s[from_:i])
+                if from_ < i:
+                    segments.append((from_, i, False))
                 from_ = i
             nesting_level += 1
-        elif s[i] == "}":
+        elif ch == "}":
             if nesting_level == 0:
                 raise Exception("Unmatched closing bracket")
             nesting_level -= 1
             if nesting_level == 0:
-                segments.append(s[from_:i + 1])
+                segments.append((from_, i + 1, True))
                 from_ = i + 1
-        i += 1
     if nesting_level != 0:
         raise Exception("Unmatched brackets")
     if from_ < len(s):
-        segments.append(s[from_:])
-    # print("segments", segments)
-
-    nodes = []
-    for segment in segments:
-        if segment.startswith("{") and segment.endswith("}"):
-            segment = "{str " + segment[1:-1] + "}"
-            n = src_to_baseformat(segment)[0]
+        segments.append((from_, len(s), False))
+
+    masked = []
+    for start, end, is_expr in segments:
+        if is_expr:
+            masked.append("(" + s[start + 1:end - 1] + ")")
         else:
-            n = String('"' + segment + '"')
-        if len(nodes) > 0:
-            nodes.append(Operator("+"))
-        nodes.append(n)
+            masked.append("".join(ch if ch == "\n" else " " for ch in s[start:end]))
+    tokens = src_to_tokens("".join(masked))
+    if n._lines is not None and n._start >= 0:
+        offset = n._start + 1
+        for token in tokens:
+            token._span += (offset << span_bits) + offset
+            token._lines = n._lines
+    exprs = iter(regular(nodes_to_baseformat(tokens)))
+
+    return [next(exprs) if is_expr else deescape(s[start:end]) for start, end, is_expr in segments]
+
 
-    # print("estr nodes", regular(flatten(nodes)))
-    # assert False
-    return RoundBrackets(nodes)
+bracket_types = {"(": RoundBrackets, "[": SquareBrackets, "{": CurlyBrackets}
+closing_bracket_types = {")": RoundBrackets, "]": SquareBrackets, "}": CurlyBrackets}
 
 
-def nodes_to_baseformat(nodes: list[Node], diag: Diagnostics | None = None) -> list[Node]:
-    """Parse a token list into a tree of bracketed expressions"""
-    diag = diag or Diagnostics()
-    stack = []
+def _iter_baseformat(nodes: t.Iterable[Node], diag: Diagnostics, keep_trivia: bool) -> t.Iterator[Node]:
+    """Build base format from tokens, yielding each top-level node when it is completed.
+
+    This is a single pass over the tokens. The brackets that are still open are
+    kept on a stack, and each token is appended to the innermost one.
+    """
     root = Sequence([])
-    stack.append(root)
+    stack = [root]
     current_list = root
-    current_list._original_nodes = []
+    root_nodes = current_nodes = root.nodes
+    root_original = current_original = root._original_nodes
 
     for n in nodes:
         if isinstance(n, LPar):
-            if n.value == "(":
-                b = RoundBrackets([])
-            elif n.value == "[":
-                b = SquareBrackets([])
-            elif n.value == "{":
-                b = CurlyBrackets([])
-            else:
+            bracket_type = bracket_types.get(n.value)
+            if bracket_type is None:
                 raise ParseError("Unknown opening bracket")
+            b = bracket_type([])
+            b.set_span(n)
+            stack.append(b)
             current_list = b
-            b._start_line = n._start_line
-            b._start_column = n._start_column
-            b._original_nodes = []
-            stack.append(current_list)
+            current_nodes = b.nodes
+            if keep_trivia:
+                current_original = b._original_nodes
+            continue
         elif isinstance(n, RPar):
-            ok_bracket = (
-                (isinstance(current_list, RoundBrackets) and n.value == ")")
-                or (isinstance(current_list, SquareBrackets) and n.value == "]")
-                or (isinstance(current_list, CurlyBrackets) and n.value == "}"))
-            if not ok_bracket:
+            if closing_bracket_types.get(n.value) is not type(current_list):
                 raise ParseError(f"Unmatched closing bracket {n.value} for {current_list.__class__.__name__}")
             b = stack.pop()
-            b._end_line = n._end_line
-            b._end_column = n._end_column
+            b._end = n._end
             current_list = stack[-1]
-            sub_parsed = nodes_to_baseformat(b.nodes, diag)
-            b.nodes = sub_parsed
-            current_list.nodes.append(b)
-            current_list._original_nodes.append(b)
-        else:
-            estr_expanded = n
-            if get_string(n) is not None and n.suffix == "e":
-                estr_expanded = e_string_to_baseformat(n.value[1:-1])
-            current_list.nodes.append(estr_expanded)
-            current_list._original_nodes.append(n)
+            current_nodes = current_list.nodes
+            current_nodes.append(b)
+            if keep_trivia:
+                current_original = current_list._original_nodes
+                current_original.append(b)
+        elif keep_trivia:
+            current_nodes.append(n)
+            current_original.append(n)
+        elif not isinstance(n, trivia_types):
+            current_nodes.append(n)
+
+        if root_nodes:
+            yield root_nodes.pop()
+            root_original.clear()
 
     if len(stack) > 1:
         diag.error(ErrorCodes.INCOMPLETE_INPUT, "Unmatched opening bracket", stack[-1])
 
-    return root.nodes
+
+def nodes_to_baseformat(nodes: list[Node], diag: Diagnostics | None = None,
+                        keep_trivia: bool = True) -> list[Node]:
+    """Parse a token list into a tree of bracketed expressions.
+
+    Without keep_trivia, whitespace, comments and unknown tokens are dropped, and
+    the brackets' _original_nodes are left empty. The tree then takes much less
+    memory, but the source text of brackets is lost, so this is for consumers
+    that only compile it.
+    """
+    return list(_iter_baseformat(nodes, diag or Diagnostics(), keep_trivia))
+
+
+def iter_baseformat(fileobj: t.TextIO, diag: Diagnostics | None = None, keep_trivia: bool = True,
+                    chunk_size: int = 65536, follow: bool = False,
+                    poll_interval: float = 0.5) -> t.Iterator[Node]:
+    """Parse a text stream into base format, yielding the top-level nodes one by one.
+
+    The stream is read in chunks, and a node is yielded as soon as its closing
+    bracket is read, so a file of many top-level forms can be processed in
+    constant memory, and a pipe as it is written. With follow, the stream is
+    read again at its end, as by tail -f, as in iter_tokens. Unmatched opening
+    brackets at the end are reported to diag when the iterator is exhausted.
+    """
+    tokens = iter_tokens(fileobj, chunk_size, follow, poll_interval)
+    return _iter_baseformat(tokens, diag or Diagnostics(), keep_trivia)
 
 
 default_operator_precedences = {
@@ -160,99 +201,289 @@ def default_precedence_lookup(operator: str) -> tuple[int, Associativity]:
     return default_operator_precedences.get(operator, (0, Associativity.LEFT))
 
 
+class OperatorTable:
+    """Operator precedences in the form used by operator_parse.
+
+    Each operator has a left and a right binding power. An operator takes the
+    operand before it from the preceding operator if its left binding power is
+    greater than the right binding power of that operator. For precedence p the
+    left power is 2p + 1, and the right power is the same, or 2p for a right
+    associative operator. Operators that are not in the table get the powers
+    from lookup if given, or those of precedence 0, left associative.
+    """
+
+    def __init__(self, precedences: dict[str, tuple[int, Associativity]] | None = None,
+                 lookup: t.Callable[[str], tuple[int, Associativity]] | None = None):
+        self.lookup = lookup
+        self.binding_powers: dict[str, tuple[int, int]] = {
+            op: self._binding_powers(precedence, associativity)
+            for op, (precedence, associativity) in (precedences or {}).items()}
+
+    @staticmethod
+    def _binding_powers(precedence: int, associativity: Associativity) -> tuple[int, int]:
+        left = 2 * precedence + 1
+        return left, left - 1 if associativity == Associativity.RIGHT else left
+
+    def binding_power(self, op: str) -> tuple[int, int]:
+        powers = self.binding_powers.get(op)
+        if powers is None:
+            if self.lookup is None:
+                return 1, 1
+            powers = self._binding_powers(*self.lookup(op))
+            self.binding_powers[op] = powers
+        return powers
+
+
+default_operator_table = OperatorTable(default_operator_precedences)
+
+
+# Binding powers that make operator_parse apply all or none of the pending operators
+_apply_all = float("-inf")
+_apply_none = float("inf")
+
+
 def operator_parse(nodes: list[Node],
-                   precedence_lookup: t.Callable[[str], tuple[int, Associativity]]
-                   = default_precedence_lookup) -> list[Node]:
-    """Parse a list of (regular) nodes into a tree of binary operations"""
+                   precedence_lookup: OperatorTable | t.Callable[[str], tuple[int, Associativity]]
+                   = default_operator_table) -> list[Node]:
+    """Parse a list of (regular) nodes into a tree of binary operations.
+
+    Operands that follow each other without an operator in between start new
+    expressions, so the result is a list of expressions. precedence_lookup may
+    also be a function giving the precedence and associativity of an operator.
+    """
+    if isinstance(precedence_lookup, OperatorTable):
+        table = precedence_lookup
+    elif precedence_lookup is default_precedence_lookup:
+        table = default_operator_table
+    else:
+        table = OperatorTable(lookup=precedence_lookup)
+    binding_power = table.binding_power
 
     output = []
-    opstack = []
+    opstack: list[tuple[Operator, int]] = []  # operators with their right binding powers
     last_wasnt_op = True
 
-    def has_ops_on_stack():
-        return len(opstack) > 0
-          
-    def apply_opstack(right: Node):
-        left = output.pop()
-        op = opstack.pop()
-        binop = BinOp(left, op.value, right)
-        binop._start_line = left._start_line
-        binop._start_column = left._start_column
-        binop._end_line = right._end_line
-        binop._end_column = right._end_column
-        output.append(binop)
-
-    def apply_opstack_1():
-        right = output.pop()
-        apply_opstack(right)
-
-    def apply_opstack_all():
-        while has_ops_on_stack():
-            apply_opstack_1()
-
-    for n in nodes:
+    for n in chain(nodes, (None,)):
         n_is_operator = isinstance(n, Operator)
+        if n_is_operator:
+            left_power, right_power = binding_power(n.value)  # type: ignore
+        elif last_wasnt_op or n is None:
+            left_power = _apply_all
+        else:
+            left_power = _apply_none
+
+        while opstack and opstack[-1][1] >= left_power:
+            op = opstack.pop()[0]
+            right = output.pop()
+            left = output.pop()
+            binop = BinOp(left, op.value, right)
+            binop.set_span(left, right)
+            output.append(binop)
 
         if n_is_operator:
-            current_prio, _ = precedence_lookup(n.value)
-            if not has_ops_on_stack():
-                opstack.append(n)
-            else:
-                while has_ops_on_stack():
-                    stack_prio, stack_assoc = precedence_lookup(opstack[-1].value)
-                    if stack_prio > current_prio:
-                        apply_opstack_1()
-                    elif stack_prio == current_prio and stack_assoc == Associativity.LEFT:
-                        apply_opstack_1()
-                    else:
-                        break
-                opstack.append(n)
+            opstack.append((n, right_power))  # type: ignore
             last_wasnt_op = False
-
-        else:
-            if last_wasnt_op:
-                apply_opstack_all()
+        elif n is not None:
             output.append(n)
             last_wasnt_op = True
 
-    apply_opstack_all()
     return output
 
 
-def src_to_baseformat(src: str, diag: Diagnostics | None = None) -> list[Node]:
-    tokens = src_to_tokens(src)
-    parsed = nodes_to_baseformat(tokens, diag)
+def src_to_baseformat(src: str, diag: Diagnostics | None = None, cache_dir: str | None = None,
+                      keep_trivia: bool = True) -> list[Node]:
+    """Parse source text into base format.
+
+    With cache_dir, the tree is looked up in an on-disk cache there by the hash of
+    src, and stored there after parsing if there were no errors. See
+    nodes_to_baseformat for keep_trivia.
+    """
+    if cache_dir is not None:
+        cached = _baseformat_cache.load(src, cache_dir, keep_trivia)
+        if cached is not None:
+            return cached
+        diag = diag or Diagnostics()
+    tokens = src_to_tokens(src, keep_trivia)
+    parsed = nodes_to_baseformat(tokens, diag, keep_trivia)
+    if cache_dir is not None and not diag.has_errors():  # type: ignore
+        _baseformat_cache.store(src, parsed, cache_dir, keep_trivia)
     return parsed
 
 
-def file_to_baseformat(filename: str) -> list[Node]:
+# Brackets, and strings and comments that may contain brackets
+rx_bracket_scan = regex.compile(r'"(?:\\.|[^"\\])*"|#[^\n]*|/\*.*?\*/|([(\[{])|[)\]}]', regex.DOTALL)
+
+
+def top_level_splits(src: str, chunk_size: int) -> list[int]:
+    """Offsets where src can be split into chunks of whole top-level forms.
+
+    A split is made after a closing bracket that ends a top-level form, once
+    the current chunk is at least chunk_size long.
+    """
+    splits = []
+    depth = 0
+    last = 0
+    for m in rx_bracket_scan.finditer(src):
+        c = src[m.start()]
+        if m.group(1) is not None:
+            depth += 1
+        elif c in ")]}":
+            depth -= 1
+            if depth == 0 and m.end() - last >= chunk_size:
+                last = m.end()
+                splits.append(last)
+    if splits and splits[-1] == len(src):
+        splits.pop()
+    return splits
+
+
+def _chunk_to_baseformat(src: str, offset: int, line: int, line_start: int) -> list[Node] | None:
+    """Parse a chunk of a larger source, with positions relative to the whole source"""
+    try:
+        tokens = src_to_tokens(src)
+    except ValueError:
+        return None
+    lines = LineIndex.from_src(src, offset, line, line_start)
+    for n in tokens:
+        n._span += (offset << span_bits) + offset
+        n._lines = lines
+    diag = Diagnostics()
+    try:
+        nodes = nodes_to_baseformat(tokens, diag)
+    except ParseError:
+        return None
+    if diag.has_errors():
+        return None
+    return nodes
+
+
+def src_to_baseformat_parallel(src: str, diag: Diagnostics | None = None,
+                               workers: int | None = None, chunk_size: int = 1 << 20) -> list[Node]:
+    """Parse a large source by splitting it at top-level forms and parsing the chunks in parallel.
+
+    Gives the same result as src_to_baseformat. If any chunk fails to parse, for
+    instance because a split ended up inside a construct the bracket scan did not
+    see, the whole source is parsed sequentially instead, which also gives the
+    usual errors.
+    """
+    splits = top_level_splits(src, chunk_size)
+    if not splits:
+        return src_to_baseformat(src, diag)
+
+    bounds = list(zip([0] + splits, splits + [len(src)]))
+    args = []
+    line = 1
+    prev = 0
+    for start, end in bounds:
+        line += src.count("\n", prev, start)
+        prev = start
+        args.append((src[start:end], start, line, src.rfind("\n", 0, start) + 1))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_chunk_to_baseformat, *zip(*args)))
+
+    if any(r is None for r in results):
+        return src_to_baseformat(src, diag)
+    return [n for r in results for n in r]  # type: ignore
+
+
+def file_to_baseformat(filename: str, mmap: bool = False, cache_dir: str | None = None,
+                       keep_trivia: bool = True) -> list[Node]:
+    if mmap and cache_dir is None:
+        with file_to_token_stream(filename) as tokens:
+            return nodes_to_baseformat(tokens, keep_trivia=keep_trivia)
     with open(filename, encoding='utf-8') as f:
         src = f.read()
-        return src_to_baseformat(src)
+        return src_to_baseformat(src, cache_dir=cache_dir, keep_trivia=keep_trivia)
+
+
+# Parsed include files by real path, with the mtime and size of the file when parsed
+_include_cache: dict[str, tuple[int, int, list[Node]]] = {}
+
+
+def cached_file_to_baseformat(path: str) -> list[Node]:
+    """Parse a file, reusing an earlier result as long as the file is unchanged.
+
+    The returned nodes are shared between callers, so they must not be modified.
+    include_includes splices in copies of them, since compiling writes to nodes.
+    """
+    key = os.path.realpath(path)
+    st = os.stat(key)
+    cached = _include_cache.get(key)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    nodes = file_to_baseformat(key)
+    _include_cache[key] = (st.st_mtime_ns, st.st_size, nodes)
+    return nodes
+
+
+def copy_tree(n: Node) -> Node:
+    """A copy of a tree that shares no nodes with it, made without recursion"""
+    def children(x: Node) -> list[Node] | None:
+        if isinstance(x, Sequence):
+            return x.nodes
+        if isinstance(x, BinOp):
+            return [x.left, x.right]
+        return None
+
+    def combine(x: Node, values: list[Node]) -> Node:
+        if isinstance(x, Sequence):
+            c = type(x)(values)
+            if x._original_nodes:
+                c._original_nodes = list(values)
+        elif isinstance(x, BinOp):
+            c = BinOp(values[0], x.op, values[1])
+        else:
+            return copy.copy(x)
+        c._span = x._span
+        c._lines = x._lines
+        return c
+
+    return fold_tree(n, children, combine)
 
 
-def include_includes(reference_path: str, nodes: list[Node]) -> list[Node]:
-    """Include the contents of any include files"""
-    reference_path = os.path.dirname(reference_path)
+def include_includes(reference_path: str, nodes: list[Node], workers: int | None = None,
+                     _including: tuple[str, ...] = ()) -> list[Node]:
+    """Include the contents of any include files.
 
-    def traverse(n: Node) -> Node | list[Node]:
+    Include files are parsed through cached_file_to_baseformat, and copies of
+    their nodes are included. With workers, the files included at the same level
+    are loaded in that many threads. An include cycle raises a ParseError.
+    """
+    including = _including + (os.path.realpath(reference_path),)
+    reference_dir = os.path.dirname(reference_path)
+
+    paths = []
+    for n in nodes:
+        path = None
         if isinstance(n, CurlyBrackets):
-            ns = regular(n.nodes)
+            ns = n.regular_nodes
             if len(ns) >= 2 and get_identifier(ns[0], "$include"):
-                filename = ns[1].value[1:-1]
-                path = os.path.join(reference_path, filename)
-                print(f"Include {reference_path} {filename} {path}")
-                included = file_to_baseformat(path)
-                included_recursed = include_includes(path, included)
-                return flatten(included_recursed)
-        return n
-
-    traversed_nodes = flatten([traverse(n) for n in nodes])
+                path = os.path.join(reference_dir, ns[1].value[1:-1])
+                if os.path.realpath(path) in including:
+                    cycle = " -> ".join(including + (os.path.realpath(path),))
+                    raise ParseError(f"Include cycle {cycle} at {n.pos_str()}")
+        paths.append(path)
+
+    loaded = {}
+    distinct = list(dict.fromkeys(p for p in paths if p is not None))
+    if workers and len(distinct) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = dict(zip(distinct, executor.map(cached_file_to_baseformat, distinct)))
+
+    traversed_nodes = []
+    for n, path in zip(nodes, paths):
+        if path is None:
+            traversed_nodes.append(n)
+            continue
+        included = loaded[path] if path in loaded else cached_file_to_baseformat(path)
+        included = [copy_tree(i) for i in included]
+        traversed_nodes.extend(include_includes(path, included, workers, including))
     return traversed_nodes
 
 
 def deparen(n: Node) -> Node:
     """Remove parentheses from a node"""
-    if isinstance(n, RoundBrackets) and len(regular(n.nodes)) == 1:
+    if isinstance(n, RoundBrackets) and len(n.regular_nodes) == 1:
         return deparen(n.nodes[0])
     return n
@@ -0,0 +1,47 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from makrell.compileall import find_mr_files
+from makrell.makrellpy.compiler import src_to_python
+
+
+def build_file(src_path: str, out_path: str):
+    """Write the Python source for a .mr file to out_path, and its line map to out_path + ".map".
+
+    The line map is JSON with the path of the source relative to the output
+    and a list of the source line of each output line, null where unknown.
+    """
+    with open(src_path, encoding='utf-8') as f:
+        src = f.read()
+    code, line_map = src_to_python(src, src_path)
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    os.makedirs(out_dir, exist_ok=True)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        f.write(code + "\n")
+    with open(out_path + ".map", 'w', encoding='utf-8') as f:
+        json.dump({"source": os.path.relpath(os.path.abspath(src_path), out_dir), "lines": line_map}, f)
+
+
+def _build_file_result(paths: tuple[str, str]) -> tuple[str, str | None]:
+    try:
+        build_file(*paths)
+        return paths[0], None
+    except Exception as e:
+        return paths[0], f"{type(e).__name__}: {e}"
+
+
+def build_py(src: str, out: str, workers: int | None = None) -> list[tuple[str, str | None]]:
+    """Transpile .mr files to Python.
+
+    If src is a directory, every .mr file under it is written to the same
+    relative path under the directory out, with a .py suffix, in parallel with
+    a process pool. Otherwise src is a file and out its output file. Returns
+    (path, error) for each file, where error is None unless the file failed.
+    """
+    if not os.path.isdir(src):
+        return [_build_file_result((src, out))]
+    jobs = [(p, os.path.join(out, os.path.relpath(p, src))[:-3] + ".py") for p in find_mr_files(src)]
+    if workers == 1 or len(jobs) <= 1:
+        return [_build_file_result(j) for j in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_build_file_result, jobs, chunksize=4))
@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 
@@ -13,6 +14,68 @@ import makrell
 
 def print_help():
     print("usage: makrell [-h] [-m] [-c CODE] [FILE]")
+    print("       makrell compileall [-j WORKERS] DIR")
+    print("       makrell build --emit-py [-j WORKERS] SRC OUT")
+
+
+def _workers(value: str) -> int | None:
+    """The -j value, a number of worker processes, where 0 means one per CPU"""
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = -1
+    if workers < 0:
+        raise argparse.ArgumentTypeError(f"invalid number of workers: {value!r}")
+    return workers or None
+
+
+def _add_workers_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("-j", dest="workers", metavar="WORKERS", type=_workers, default=None,
+                        help="number of worker processes, 0 for one per CPU (the default)")
+
+
+def compileall(args: list[str]) -> int:
+    from makrell.compileall import compile_dir
+
+    parser = argparse.ArgumentParser(
+        prog="makrell compileall", description="Compile the .mr files under DIR to bytecode files.")
+    _add_workers_argument(parser)
+    parser.add_argument("dir", metavar="DIR")
+    opts = parser.parse_args(args)
+
+    results = compile_dir(opts.dir, opts.workers)
+    failed = 0
+    compiled = 0
+    for path, was_compiled, error in results:
+        if error is not None:
+            failed += 1
+            print(f"*** Error compiling {path}: {error}", file=sys.stderr)
+        elif was_compiled:
+            compiled += 1
+    print(f"{compiled} compiled, {len(results) - compiled - failed} up to date, {failed} failed")
+    return 1 if failed else 0
+
+
+def build(args: list[str]) -> int:
+    from makrell.build import build_py
+
+    parser = argparse.ArgumentParser(
+        prog="makrell build", description="Transpile the .mr file or directory SRC to Python at OUT.")
+    parser.add_argument("--emit-py", action="store_true", required=True,
+                        help="write Python source, with a line map beside each file")
+    _add_workers_argument(parser)
+    parser.add_argument("src", metavar="SRC")
+    parser.add_argument("out", metavar="OUT")
+    opts = parser.parse_args(args)
+
+    results = build_py(opts.src, opts.out, opts.workers)
+    failed = 0
+    for path, error in results:
+        if error is not None:
+            failed += 1
+            print(f"*** Error building {path}: {error}", file=sys.stderr)
+    print(f"{len(results) - failed} built, {failed} failed")
+    return 1 if failed else 0
 
 
 def main():
@@ -28,6 +91,12 @@ def main():
         importlib.import_module(args[1])
         return
     
+    if args[0] == "compileall":
+        sys.exit(compileall(args[1:]))
+
+    if args[0] == "build":
+        sys.exit(build(args[1:]))
+
     if args[0] == "-c" and len(args) == 2:
         r = eval_src(args[1])
         if r is not None:
@@ -0,0 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from makrell import (
+    MakrellLoader, _bytecode_path, _compile_source, _pyc_data, _pyc_is_current, _source_hash, _write_atomic)
+
+
+def find_mr_files(root: str) -> list[str]:
+    """The .mr files under root, in sorted order"""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        found.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.endswith(".mr"))
+    return found
+
+
+def compile_file(path: str) -> bool:
+    """Compile a .mr file to the bytecode file the loader uses.
+
+    Returns False without compiling if the bytecode file is already up to date
+    with the source, by the hash in it. Modules that use importm are compiled,
+    but no bytecode file is written, as by the loader.
+    """
+    loader = MakrellLoader(os.path.splitext(os.path.basename(path))[0], path)
+    source = loader.get_data(path)
+    source_hash = _source_hash(source)
+    bytecode_path = _bytecode_path(path)
+    try:
+        if _pyc_is_current(loader.get_data(bytecode_path), source_hash):
+            return False
+    except OSError:
+        pass
+    code, cacheable = _compile_source(source, path)
+    if cacheable:
+        _write_atomic(bytecode_path, _pyc_data(code, source_hash))
+    return True
+
+
+def _compile_file_result(path: str) -> tuple[str, bool, str | None]:
+    # Errors are returned rather than raised, so one bad file doesn't end the run
+    try:
+        return path, compile_file(path), None
+    except Exception as e:
+        return path, False, f"{type(e).__name__}: {e}"
+
+
+def compile_dir(root: str, workers: int | None = None) -> list[tuple[str, bool, str | None]]:
+    """Compile all .mr files under root, in parallel with a process pool.
+
+    Returns (path, compiled, error) for each file, where compiled is False for
+    files that were up to date, and error is None unless the file failed.
+    With workers=1, the files are compiled in this process.
+    """
+    paths = find_mr_files(root)
+    if workers == 1 or len(paths) <= 1:
+        return [_compile_file_result(p) for p in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_compile_file_result, paths, chunksize=4))
@@ -8,13 +8,13 @@ from typing import Optional
 from lsprotocol import types as lsp
 
 from pygls.server import LanguageServer
-from makrell.ast import Sequence
-from makrell.baseformat import src_to_baseformat
+from makrell.ast import LineIndex, Node, Sequence
+from makrell.baseformat import nodes_to_baseformat
 
 import makrell.makrellpy.compiler as mrc
 from makrell.parsing import flatten
 import makrell.parsing
-from makrell.tokeniser import regular
+from makrell.tokeniser import regular, retokenise, src_to_tokens
 
 COUNT_DOWN_START_IN_SECONDS = 10
 COUNT_DOWN_SLEEP_IN_SECONDS = 1
@@ -38,19 +38,57 @@ class MakrellLanguageServer(LanguageServer):
 
 mr_server = MakrellLanguageServer("makrell-language-server", "v0.8.0")
 
+# source and tokens of open documents, updated incrementally on changes
+_documents: dict[str, tuple[str, list[Node]]] = {}
 
-def _validate(ls, params):
+
+def _offset(lines: LineIndex, source: str, position: lsp.Position) -> int:
+    if position.line + 1 - lines.first_line >= len(lines.starts):
+        return len(source)
+    return min(lines.offset(position.line + 1, position.character + 1), len(source))
+
+
+def _document_tokens(uri: str, source: str, changes=None) -> list[Node]:
+    """Tokens of a document, retokenising only the changed ranges when possible"""
+    if uri in _documents and changes:
+        old_source, tokens = _documents[uri]
+        try:
+            for change in changes:
+                if not isinstance(change, lsp.TextDocumentContentChangeEvent_Type1):
+                    raise ValueError("full document change")
+                lines = tokens[0]._lines if tokens else LineIndex.from_src(old_source)
+                start = _offset(lines, old_source, change.range.start)
+                end = _offset(lines, old_source, change.range.end)
+                new_source = old_source[:start] + change.text + old_source[end:]
+                tokens = retokenise(tokens, new_source, start, end, start + len(change.text))
+                old_source = new_source
+            if old_source == source:
+                _documents[uri] = (source, tokens)
+                return tokens
+        except ValueError:
+            pass
+    tokens = src_to_tokens(source)
+    _documents[uri] = (source, tokens)
+    return tokens
+
+
+def _validate(ls, params, changes=None):
     ls.show_message_log("Validating ...")
 
     text_doc = ls.workspace.get_document(params.text_document.uri)
 
     source = text_doc.source
-    diagnostics = _validate_mr("A" + source) if source else []
+    try:
+        tokens = _document_tokens(text_doc.uri, source, changes)
+    except ValueError:
+        _documents.pop(text_doc.uri, None)
+        return
+    diagnostics = _validate_mr(source, tokens) if source else []
 
     ls.publish_diagnostics(text_doc.uri, diagnostics)
 
 
-def _validate_mr(source):
+def _validate_mr(source, tokens: list[Node] | None = None):
     """Validates mr file."""
     diagnostics = []
 
@@ -76,14 +114,14 @@ def _validate_mr(source):
     # )
     # diagnostics.append(d)
 
-    cc = mrc.CompilerContext()
-    nodes = src_to_baseformat(source)
+    cc = mrc.CompilerContext(mrc.compile_mr)
+    nodes = nodes_to_baseformat(tokens if tokens is not None else src_to_tokens(source))
     s = Sequence(flatten(regular(nodes)))
     mrc.compile_mr(s, cc)
     for i in cc.diag.items:
         n = i.node
-        # line = i.node._start_line
-        # column = i.node._start_column
+        start_line, start_column = n.start_pos()
+        end_line, end_column = n.end_pos()
         severity = lsp.DiagnosticSeverity.Information
         match i.severity:
             case makrell.parsing.DiagnosticSeverity.Error:
@@ -97,8 +135,8 @@ def _validate_mr(source):
 
         d = lsp.Diagnostic(
             range=lsp.Range(
-                start=lsp.Position(line=n._start_line - 1, character=n._start_column - 1),
-                end=lsp.Position(line=n._end_line - 1, character=n._end_column - 1),
+                start=lsp.Position(line=start_line - 1, character=start_column - 1),
+                end=lsp.Position(line=end_line - 1, character=end_column - 1),
             ),
             message=i.message,
             source=type(mr_server).__name__,
@@ -175,12 +213,12 @@ async def count_down_10_seconds_non_blocking(ls, *args):
 @mr_server.feature(lsp.TEXT_DOCUMENT_DID_CHANGE)
 def did_change(ls, params: lsp.DidChangeTextDocumentParams):
     """Text document did change notification."""
-    _validate(ls, params)
+    _validate(ls, params, params.content_changes)
 
 
 @mr_server.feature(lsp.TEXT_DOCUMENT_DID_CLOSE)
 def did_close(server: MakrellLanguageServer, params: lsp.DidCloseTextDocumentParams):
-    pass
+    _documents.pop(params.text_document.uri, None)
 
 
 @mr_server.feature(lsp.TEXT_DOCUMENT_DID_OPEN)
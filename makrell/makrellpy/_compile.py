@@ -1,29 +1,85 @@
 import ast as py
+import typing as t
 from makrell.ast import (
     BinOp, Identifier, Number, Sequence, CurlyBrackets, Node, RoundBrackets,
-    SquareBrackets, String)
+    SquareBrackets, String, trivia_types)
+from makrell.baseformat import e_string_parts
 from makrell.makrellpy._compile_curly_reserved import compile_curly_reserved
 from makrell.makrellpy._compiler_common import CompilerContext
 from makrell.tokeniser import regular
 from makrell.parsing import (get_binop, get_operator, python_value, get_identifier)
 from .py_primitives import simple_reserved
-from ._compile_binop import compile_binop
+from ._compile_binop import compile_binop, python_binop_parts
 from ._compiler_common import transfer_pos
 import makrell.makrellpy.pyast_builder as pb
 
 
+def _with_pos(n: Node, pa: py.AST | list[py.AST] | None) -> t.Any:
+    if pa is not None:
+        if isinstance(pa, list):
+            for p in pa:
+                transfer_pos(n, p)
+        else:
+            transfer_pos(n, pa)
+    return pa
+
+
+def _nested_parts(n: Node, cc: CompilerContext) -> tuple[list[Node], t.Callable[[list], py.AST]] | None:
+    """The children of a list, tuple or Python operator, and a function giving its Python AST from them compiled"""
+    match n:
+        case SquareBrackets():
+            return cc.operator_parse_node(n), lambda cs: py.List(cs, ctx=py.Load())
+        case RoundBrackets():
+            nodes = cc.operator_parse_node(n)
+            if len(nodes) == 0:
+                # () is null
+                return [], lambda cs: pb.constant(None)
+            if len(nodes) == 1:
+                # (x) is x
+                return nodes, lambda cs: cs[0]
+            # (x …) is a tuple
+            if get_identifier(nodes[-1], "_"):
+                nodes = nodes[:-1]
+            return nodes, lambda cs: py.Tuple(cs, ctx=py.Load())
+        case BinOp():
+            return python_binop_parts(n)
+    return None
+
+
+def _compile_nested(n: Node, parts: tuple[list[Node], t.Callable[[list], py.AST]], cc: CompilerContext) -> py.AST:
+    """Compile nested lists, tuples and Python operators with an explicit stack.
+
+    These nest deepest in generated code. Other nodes in them are compiled by
+    compile_mr, which comes back here for the nested nodes inside those.
+    """
+    # node, its children, building its AST from them, the children compiled so far
+    stack = [(n, parts[0], parts[1], [])]
+    while True:
+        node, children, build, compiled = stack[-1]
+        if len(compiled) < len(children):
+            child = children[len(compiled)]
+            child_parts = _nested_parts(child, cc)
+            if child_parts is not None:
+                stack.append((child, child_parts[0], child_parts[1], []))
+                continue
+            pa = compile_mr(child, cc)
+        else:
+            stack.pop()
+            pa = build(compiled)
+            if not stack:
+                return pa
+            child = node
+        stack[-1][3].append(_with_pos(child, pa))
+
+
 def compile_mr(n: Node, cc: CompilerContext) -> py.AST | list[py.AST] | None:
+    parts = _nested_parts(n, cc)
+    if parts is not None:
+        return _compile_nested(n, parts, cc)
 
     # recurse through this
     def c(n: Node) -> py.expr:  # py.AST | list[py.AST] | None:
-        pa = compile_mr(n, cc)
-        if pa is not None:
-            if isinstance(pa, list):
-                for p in pa:
-                    transfer_pos(n, p)
-            else:
-                transfer_pos(n, pa)
-        return pa  # type: ignore
+        return _with_pos(n, compile_mr(n, cc))
 
     # curly brackets
     def curly(n: CurlyBrackets) -> py.AST | list[py.AST] | None:
@@ -32,7 +88,7 @@ def compile_mr(n: Node, cc: CompilerContext) -> py.AST | list[py.AST] | None:
             return py.Constant(None)
 
         n0 = nodes[0]
-        reg_nodes = regular(nodes)
+        reg_nodes = n.regular_nodes
 
         # operator as function call
         if get_operator(reg_nodes[0]):
@@ -50,7 +106,7 @@ def compile_mr(n: Node, cc: CompilerContext) -> py.AST | list[py.AST] | None:
             r = pb.lambda_(args, body)
             return r
 
-        opp_nodes = cc.operator_parse(reg_nodes)
+        opp_nodes = cc.operator_parse_node(n)
         opp_n0 = opp_nodes[0]
 
         if get_identifier(n0):
@@ -63,10 +119,10 @@ def compile_mr(n: Node, cc: CompilerContext) -> py.AST | list[py.AST] | None:
             # meta symbol call
             # BUG: does not handle a.f calls
             if n0.value in cc.meta.symbols:
-                if len(nodes) <= 2:  # whitespace after identifier
-                    meta_args = []
-                else:
-                    meta_args = nodes[2:]
+                meta_args = nodes[1:]
+                if meta_args and isinstance(meta_args[0], trivia_types):
+                    # whitespace after identifier, unless parsed without trivia
+                    meta_args = meta_args[1:]
                 f = cc.meta.symbols[n0.value]
                 mrf = f
                 # mrf = cc.meta.meta_runnable_func(f)
@@ -126,6 +182,26 @@ def compile_mr(n: Node, cc: CompilerContext) -> py.AST | list[py.AST] | None:
             # regular identifier
             return pb.name_ld(value)
             
+        case String(suffix="e"):
+            # e-string, as an f-string
+            n._type = Identifier("str")
+            values = []
+            for part in e_string_parts(n):
+                if isinstance(part, str):
+                    if part:
+                        values.append(pb.constant(part))
+                    continue
+                exprs = cc.operator_parse_node(part)
+                if len(exprs) == 1:
+                    values.append(py.FormattedValue(c(exprs[0]), ord("s"), None))
+                elif len(exprs) > 1:
+                    # several expressions are the arguments of str, as in {str b "utf-8"}
+                    call = CurlyBrackets([Identifier("str"), *part.nodes])
+                    call.set_span(part)
+                    values.append(py.FormattedValue(c(call), -1, None))
+                # and an empty {} gives nothing, like {str}
+            return py.JoinedStr(values)
+
         case String():
             # string constant, bin/oct/hex number, regex, datetime
             n._type = Identifier("str")
@@ -138,25 +214,9 @@ def compile_mr(n: Node, cc: CompilerContext) -> py.AST | list[py.AST] | None:
             return pb.constant(python_value(n))
                        
         case BinOp(left, op, right):
+            # other than Python operators, which are compiled by _compile_nested
             return compile_binop(n, cc, compile_mr)
         
-        case RoundBrackets(nodes):
-            nodes = cc.operator_parse(regular(nodes))
-            if len(nodes) == 0:
-                # () is null
-                return pb.constant(None)
-            if len(nodes) == 1:
-                # (x) is x
-                return c(nodes[0])
-            else:
-                # (x …) is a tuple
-                last_is_dummy = get_identifier(nodes[-1], "_")
-                ns = nodes[:-1] if last_is_dummy else nodes
-                return py.Tuple([c(n) for n in ns], ctx=py.Load())
-        
-        case SquareBrackets(nodes):
-            return py.List([c(n) for n in cc.operator_parse(regular(nodes))], ctx=py.Load())
-        
         case CurlyBrackets(nodes):
             return curly(n)
         
@@ -166,6 +226,6 @@ def compile_mr(n: Node, cc: CompilerContext) -> py.AST | list[py.AST] | None:
             if len(nodes) == 1:
                 return c(nodes[0])
             else:
-                return [c(n) for n in cc.operator_parse(nodes)]
+                return [c(n) for n in cc.operator_parse_node(n)]
             
     raise Exception(f"Unknown type: {type(n)}")
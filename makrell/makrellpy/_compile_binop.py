@@ -1,13 +1,26 @@
 import ast as py
+import typing as t
 from makrell.ast import (BinOp, CurlyBrackets, Identifier, Sequence, Node)
 from makrell.baseformat import (ParseError, deparen)
 from makrell.makrellpy._compiler_common import CompilerContext, stmt_wrap, transfer_pos
-from makrell.tokeniser import regular
 from makrell.parsing import (get_binop, get_square_brackets, get_identifier)
 from .py_primitives import bin_ops, bool_ops, compare_ops
 import makrell.makrellpy.pyast_builder as pb
 
 
+def python_binop_parts(n: BinOp) -> tuple[list[Node], t.Callable[[list[py.expr]], py.expr]] | None:
+    """The operands of a Python operator, and a function giving its Python AST from them compiled"""
+    op = n.op
+    if op in bin_ops:
+        return [n.left, n.right], lambda cs: pb.binop(cs[0], bin_ops[op], cs[1])
+    elif op in bool_ops:
+        n._type = Identifier("bool")
+        return [n.left, n.right], lambda cs: pb.boolop(bool_ops[op], cs)
+    elif op in compare_ops:
+        return [n.left, n.right], lambda cs: pb.compare(cs[0], [compare_ops[op]], [cs[1]])
+    return None
+
+
 def compile_binop(n: BinOp, cc: CompilerContext, compile_mr) -> py.AST | list[py.AST] | None:
     left = n.left
     right = n.right
@@ -36,13 +49,13 @@ def compile_binop(n: BinOp, cc: CompilerContext, compile_mr) -> py.AST | list[py
                 if aid := get_identifier(left):
                     args = aid.value
                 elif (asb := get_square_brackets(left)) != None:
-                    args = [n.value for n in regular(asb.nodes)]
+                    args = [n.value for n in asb.regular_nodes]
                 else:
                     raise Exception(f"Invalid left side of ->: {left} {type(left)}")
                 
                 if isinstance(right, Sequence) and len(right.nodes) > 1 and get_identifier(right.nodes[0], "do"):
                     cc.push_fun_defs_scope()
-                    rnodes = regular(right.nodes)
+                    rnodes = right.regular_nodes
                     # body = stmt_wrap([c(n) for n in cc.operator_parse(rnodes[1:])])
                     stmts = stmt_wrap([c(n) for n in cc.operator_parse(rnodes[1:])])
                     fun_defs = cc.pop_fun_defs_scope()
@@ -104,13 +117,9 @@ def compile_binop(n: BinOp, cc: CompilerContext, compile_mr) -> py.AST | list[py
                 return None
 
     # python operator
-    if op in bin_ops:
-        return pb.binop(c(left), bin_ops[op], c(right))
-    elif op in bool_ops:
-        n._type = Identifier("bool")
-        return pb.boolop(bool_ops[op], [c(left), c(right)])
-    elif op in compare_ops:
-        return pb.compare(c(left), [compare_ops[op]], [c(right)])
+    if parts := python_binop_parts(n):
+        operands, build = parts
+        return build([c(operand) for operand in operands])
     elif op in cc.operators:
         # makrell operator
         return mr_binop(left, op, right)
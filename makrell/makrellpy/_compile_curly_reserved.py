@@ -10,7 +10,7 @@ import makrell.makrellpy.pyast_builder as pb
 
 
 def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, opp_nodes) -> py.AST | list[py.AST] | None:
-    reg_nodes = regular(n.nodes)
+    reg_nodes = n.regular_nodes
     nodes = opp_nodes
     original = n
 
@@ -71,7 +71,7 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
             if parlen >= 2:
                 # print("fun", nodes)
                 name = nodes[1].value
-                args = py.arguments(args=[py.arg(n.value) for n in regular(nodes[2])],
+                args = py.arguments(args=[py.arg(n.value) for n in nodes[2].regular_nodes],
                                     posonlyargs=[], kwonlyargs=[], kw_defaults=[], defaults=[])
                 body = stmt_wrap([c(n) for n in regular(nodes[3:])])
                 return py.FunctionDef(name=name, args=args, body=body, decorator_list=[])
@@ -91,7 +91,7 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
                 if params_sb is None:
                     body = [c(n) for n in nodes[2:]]
                 else:
-                    params = operator_parse(params_sb.nodes)
+                    params = cc.operator_parse_node(params_sb)
                     for p in params:
                         if ident := get_identifier(p):
                             n = py.Name(ident.value, py.Load())
@@ -135,7 +135,7 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
                     imports_names.append(name)
                 elif nbo := get_binop(n, "@"):
                     name = dotted_ident(nbo.left)
-                    rights = regular(nbo.right.nodes)
+                    rights = nbo.right.regular_nodes
                     aliases = [r.value for r in rights]
                     import_from_names.append((name, aliases))
             implib = py.Import([py.alias("importlib")])
@@ -147,7 +147,11 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
                 for module, names in import_from_names:
                     cc.import_with_mr_meta(
                         import_module(module), names, cc.meta.symbols)
-                return py.Pass()
+                # noted in the Python source from module_to_python
+                p = py.Pass()
+                p.mr_comment = "macros run at compile time: " + " ".join(
+                    f"{module}@[{' '.join(names)}]" for module, names in import_from_names)
+                return p
 
             def make_import_from(module: str, names: list[str]) -> py.ImportFrom:
                 return py.ImportFrom(module, [py.alias(n) for n in names], 0)
@@ -207,7 +211,7 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
             body_ended = False
             for n in nodes[1:]:
                 if get_curly(n, "catch"):
-                    nnodes = operator_parse(regular(n.nodes))
+                    nnodes = cc.operator_parse_node(n)
                     if len(nnodes) == 1:
                         # bare catch
                         exnodes = stmt_wrap([c(n) for n in nnodes[1:]], auto_return=False)
@@ -228,11 +232,11 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
                         eh = py.ExceptHandler(typ, name, exnodes)
                         handlers.append(transfer_pos(n, eh))
                 elif get_curly(n, "finally"):
-                    nnodes = operator_parse(regular(n.nodes))
+                    nnodes = cc.operator_parse_node(n)
                     finalbody += stmt_wrap([c(fn) for fn in nnodes[1:]], auto_return=False)
                     body_ended = True
                 elif get_curly(n, "else"):
-                    nnodes = operator_parse(regular(n.nodes))
+                    nnodes = cc.operator_parse_node(n)
                     orelse += [c(fn) for fn in nnodes[1:]]
                     body_ended = True
                 else:
@@ -305,7 +309,7 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
                 name = nodes[2].value
                 args_node = get_square_brackets(nodes[3]) or RoundBrackets([])
                 args = py.arguments(
-                    args=[py.arg(n.value) for n in regular(args_node.nodes)],
+                    args=[py.arg(n.value) for n in args_node.regular_nodes],
                     posonlyargs=[], kwonlyargs=[], kw_defaults=[], defaults=[]
                 )
                 body = stmt_wrap([c(n) for n in regular(nodes[4:])])
@@ -436,11 +440,11 @@ def compile_curly_reserved(n: CurlyBrackets, cc: CompilerContext, compile_mr, op
                         op = reg_nodes[2].value
                         precedence = int(reg_nodes[3].value)
                         associativity = Associativity.RIGHT if is_rass else Associativity.LEFT
-                        cc.operators[op] = (precedence, associativity)
+                        cc.define_operator(op, precedence, associativity)
 
                         expr_start = 5 if is_rass else 4
                         expr_nodes = reg_nodes[expr_start:]
-                        body = c(operator_parse(expr_nodes, cc.op_precedence)[0])
+                        body = c(operator_parse(expr_nodes, cc.operator_table)[0])
                         arguments = ["$left", "$right"]
                         expr = pb.lambda_(arguments, body)
                         cc.meta.symbols[op] = expr
@@ -1,10 +1,13 @@
 import ast as py
+from dataclasses import fields
+import itertools
 import types
 from typing import Any, cast
 from makrell.ast import (
-    BinOp, Identifier, Number, Sequence, CurlyBrackets, Node, SquareBrackets, String)
+    BinOp, Identifier, Number, Sequence, CurlyBrackets, Node, SquareBrackets, String, fold_tree)
 from makrell.baseformat import (
-    Associativity, default_precedence_lookup, operator_parse, src_to_baseformat)
+    Associativity, OperatorTable, default_operator_precedences, default_precedence_lookup, operator_parse,
+    src_to_baseformat)
 from makrell.tokeniser import regular
 from makrell.parsing import (Diagnostics, flatten, get_identifier)
 
@@ -45,27 +48,79 @@ def dotted_ident(n: Node) -> str:
         raise Exception(f"Invalid identifier: {n}")
 
 
+def fix_missing_locations(node: py.AST) -> py.AST:
+    """ast.fix_missing_locations, with an explicit stack instead of recursion"""
+    stack = [(node, 1, 0, 1, 0)]
+    while stack:
+        node, lineno, col_offset, end_lineno, end_col_offset = stack.pop()
+        attributes = node._attributes
+        if 'lineno' in attributes:
+            if not hasattr(node, 'lineno'):
+                node.lineno = lineno
+            else:
+                lineno = node.lineno
+        if 'end_lineno' in attributes:
+            if getattr(node, 'end_lineno', None) is None:
+                node.end_lineno = end_lineno
+            else:
+                end_lineno = node.end_lineno
+        if 'col_offset' in attributes:
+            if not hasattr(node, 'col_offset'):
+                node.col_offset = col_offset
+            else:
+                col_offset = node.col_offset
+        if 'end_col_offset' in attributes:
+            if getattr(node, 'end_col_offset', None) is None:
+                node.end_col_offset = end_col_offset
+            else:
+                end_col_offset = node.end_col_offset
+        stack.extend((child, lineno, col_offset, end_lineno, end_col_offset)
+                     for child in py.iter_child_nodes(node))
+    return node
+
+
 def transfer_pos(n: Node, pa: py.AST) -> py.AST:
     try:
-        pa.lineno = n._start_line  # type: ignore
-        pa.col_offset = n._start_column  # type: ignore
-        pa.end_lineno = n._end_line  # type: ignore
-        pa.end_col_offset = n._end_column  # type: ignore
+        pa.lineno, pa.col_offset = n.start_pos()  # type: ignore
+        pa.end_lineno, pa.end_col_offset = n.end_pos()  # type: ignore
     except AttributeError:
         pass
     return pa
 
 
+# Versions of operator tables. Every table state gets a number that is unique
+# across compiler contexts, so cached operator parses can be keyed on it.
+_operator_table_versions = itertools.count(1)
+
+
 class CompilerContext:
     def __init__(self, compile_mr):
         self.compile_mr = compile_mr
         self.gensym_counter = 0
         self.fun_defs = [[]]  # a stack
         self.operators = {}
+        self.operators_version = next(_operator_table_versions)
+        self.operator_table = OperatorTable(default_operator_precedences)
         self.meta = Meta(self)
         self.body_stack = []
         self.diag: Diagnostics = Diagnostics()
         self.running_in_meta = False
+        # modules whose macros were imported with importm
+        self.mr_meta_imports: list[str] = []
+
+    def copy_from(self, other: 'CompilerContext'):
+        """Make this new context a copy of the compiled state of other.
+
+        The operator table and the generated function definitions are shared,
+        since they are not modified after they are created.
+        """
+        self.gensym_counter = other.gensym_counter
+        self.fun_defs = [list(other.fun_defs[0])]
+        self.operators = dict(other.operators)
+        self.operators_version = other.operators_version
+        self.operator_table = other.operator_table
+        self.mr_meta_imports = list(other.mr_meta_imports)
+        self.meta.copy_from(other.meta)
 
     def gensym(self) -> str:
         self.gensym_counter += 1
@@ -76,13 +131,32 @@ class CompilerContext:
             return self.operators[op]
         return default_precedence_lookup(op)
 
+    def define_operator(self, op: str, precedence: int, associativity: Associativity):
+        self.operators[op] = (precedence, associativity)
+        self.operators_version = next(_operator_table_versions)
+        self.operator_table = OperatorTable(default_operator_precedences | self.operators)
+
     def operator_parse(self, nodes: list[Node]) -> list[Node]:
-        return operator_parse(regular(nodes), self.op_precedence)
+        return operator_parse(regular(nodes), self.operator_table)
+
+    def operator_parse_node(self, n: Sequence) -> list[Node]:
+        """Operator parse the regular children of n.
+
+        The result is cached on n and reused as long as the children and the
+        operator table are unchanged, so it must not be modified.
+        """
+        nodes = n.regular_nodes
+        cached = n._operator_parsed
+        if cached is None or cached[0] != self.operators_version or cached[1] is not nodes:
+            cached = (self.operators_version, nodes, operator_parse(nodes, self.operator_table))
+            n._operator_parsed = cached
+        return cached[2]
 
     def import_with_mr_meta(self, src_module, names, dest_module):
         src_meta = src_module.__dict__.get("_mr_meta_", None)
+        self.mr_meta_imports.append(src_module.__name__)
         for src in src_meta:
-            bf = src_to_baseformat(src)
+            bf = src_to_baseformat(src, keep_trivia=False)
             self.meta.run(bf)
 
     def run(self, nodes: list[Node]) -> Any:
@@ -91,7 +165,7 @@ class CompilerContext:
             pyast = [pyast]
         pyast = self.fun_defs[0] + pyast
         body = py.Module(stmt_wrap(pyast, auto_return=False), type_ignores=[])
-        py.fix_missing_locations(body)
+        fix_missing_locations(body)
         c = compile(body, "", mode="exec")
         exec(c, {}, {})
     
@@ -130,6 +204,59 @@ from makrell.baseformat import operator_parse, src_to_baseformat
         exec(src_init, self.globals)
         # self.symbols['operator_parse'] = lambda ns: cc.operator_parse(ns)
 
+    def copy_from(self, other: 'Meta'):
+        """Make this environment a copy of other.
+
+        Lists, dicts, sets and tuples in it are copied, and functions defined by
+        the meta code of other are rebound to the globals here, with copies of
+        their closure cells and defaults. Other objects, such as instances of
+        classes, are shared, so meta code that modifies them affects other. The
+        meta code of the core creates none.
+        """
+        old_globals = other.globals
+        new_globals = {'$context': self.cc}
+        memo: dict[int, Any] = {}
+
+        def copy(v):
+            r = memo.get(id(v))
+            if r is not None:
+                return r
+            if isinstance(v, types.FunctionType) and v.__globals__ is old_globals:
+                closure = None if v.__closure__ is None else tuple(copy(cell) for cell in v.__closure__)
+                if id(v) in memo:
+                    # copied already through a cell of its own closure
+                    return memo[id(v)]
+                r = types.FunctionType(v.__code__, new_globals, v.__name__, copy(v.__defaults__), closure)
+                r.__kwdefaults__ = copy(v.__kwdefaults__)
+                r.__dict__.update(v.__dict__)
+            elif type(v) is types.CellType:
+                r = memo[id(v)] = types.CellType()
+                try:
+                    r.cell_contents = copy(v.cell_contents)
+                except ValueError:
+                    pass  # an empty cell
+            elif type(v) is set:
+                r = set(copy(x) for x in v)
+            elif type(v) is list:
+                r = memo[id(v)] = []
+                r.extend(copy(x) for x in v)
+            elif type(v) is dict:
+                r = memo[id(v)] = {}
+                r.update((k, copy(x)) for k, x in v.items())
+            elif type(v) is tuple:
+                r = tuple(copy(x) for x in v)
+            else:
+                return v
+            memo[id(v)] = r
+            return r
+
+        for k, v in old_globals.items():
+            if k != '$context':
+                new_globals[k] = v if k.startswith("__") else copy(v)
+        self.globals = new_globals
+        self.symbols = {k: copy(v) for k, v in other.symbols.items()}
+        self.node_blocks = list(other.node_blocks)
+
     def run(self, nodes: list[Node]) -> Any:
         # print("running meta", len(nodes))
         self.node_blocks += nodes
@@ -142,7 +269,7 @@ from makrell.baseformat import operator_parse, src_to_baseformat
         # print("pyast", pyast)
         pyast = self.cc.fun_defs[0] + pyast
         body = py.Module(stmt_wrap(pyast, auto_return=False), type_ignores=[])
-        py.fix_missing_locations(body)
+        fix_missing_locations(body)
         c = compile(body, "", mode="exec")
         exec(c, self.globals, self.symbols)
 
@@ -156,31 +283,45 @@ from makrell.baseformat import operator_parse, src_to_baseformat
 
     def quote(self, n: Node, raw: bool = False) -> Node:
         # TODO: cleanup raw usage
-        match n:
-            case CurlyBrackets(nodes) if (get_identifier(nodes[0], "unquote")
-                                          or get_identifier(nodes[0], "$")):
-                unquoted = self.cc.operator_parse(regular(nodes[1:]))
-                return unquoted[0]
-            case False:
-                return Identifier("false")
-            case True:
-                return Identifier("true")
-            case None:
-                return Identifier("null")
-            case Node():
-                name = n.__class__.__name__
-                args = [self.quote(v) for (k, v) in n.__dict__.items()
-                        if not k.startswith("_")]
-                ident = Identifier(name)
-                cb = CurlyBrackets([ident, *args])
-                cb._original_nodes = args
-                return cb
-            case list(ns):
-                if not raw:
-                    ns = regular(ns)
-                return SquareBrackets([self.quote(n) for n in ns])
-            case s if isinstance(n, str):
-                return String('"' + s + '"')
-            case n if isinstance(n, int):
-                return Number(str(n))
-        self.cc.diag.error(f"Invalid node to quote: {n}")
+
+        def is_unquote(x) -> bool:
+            return (isinstance(x, CurlyBrackets) and len(x.nodes) > 0
+                    and (get_identifier(x.nodes[0], "unquote") or get_identifier(x.nodes[0], "$")))
+
+        def children(x) -> list | None:
+            if is_unquote(x):
+                return None
+            if isinstance(x, Node):
+                return [getattr(x, f.name) for f in fields(x) if not f.name.startswith("_")]
+            if isinstance(x, list):
+                return x if raw and x is n else regular(x)
+            return None
+
+        def combine(x, quoted: list[Node]) -> Node | None:
+            match x:
+                case CurlyBrackets(nodes) if is_unquote(x):
+                    unquoted = self.cc.operator_parse(regular(nodes[1:]))
+                    return unquoted[0]
+                case False:
+                    return Identifier("false")
+                case True:
+                    return Identifier("true")
+                case None:
+                    return Identifier("null")
+                case Node():
+                    name = x.__class__.__name__
+                    ident = Identifier(name)
+                    cb = CurlyBrackets([ident, *quoted])
+                    cb._original_nodes = quoted
+                    return cb
+                case list():
+                    return SquareBrackets(quoted)
+                case s if isinstance(x, str):
+                    return String('"' + s + '"')
+                case x if isinstance(x, int):
+                    return Number(str(x))
+            self.cc.diag.error(f"Invalid node to quote: {x}")
+            return None
+
+        # nodes nest arbitrarily deep in generated code, so this is not recursive
+        return fold_tree(n, children, combine)
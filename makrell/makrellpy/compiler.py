@@ -1,5 +1,7 @@
 import ast as py
+import copy
 import os
+from types import CodeType
 from typing import Any
 from importlib import import_module
 from makrell.ast import (Sequence, Node)
@@ -8,7 +10,7 @@ from makrell.baseformat import (
     src_to_baseformat, include_includes)
 from makrell.tokeniser import regular
 from makrell.parsing import (Diagnostics, flatten)
-from ._compiler_common import stmt_wrap
+from ._compiler_common import fix_missing_locations, stmt_wrap
 from ._compile import (CompilerContext, compile_mr)
 
 
@@ -21,18 +23,40 @@ def import_mr_module(name: str, dest_module, alias: str | None = None) -> py.Mod
     
     cc = CompilerContext(compile_mr)
     run_core_mr(cc)
-    pyast = cc.operator_parse(regular(src_to_baseformat(f"import {name}")))
+    pyast = cc.operator_parse(src_to_baseformat(f"import {name}", keep_trivia=False))
     pyast = cc.fun_defs[0] + pyast
     m = py.Module(stmt_wrap(pyast, auto_return=False), type_ignores=[])
-    py.fix_missing_locations(m)
+    fix_missing_locations(m)
     return m
 
 
-def run_core_mr(cc: CompilerContext):
+# A context with the core sources compiled, built once per process
+_core_context: CompilerContext | None = None
+
+
+def _compile_core_mr(cc: CompilerContext):
     core_mr = get_src("core.mrpy")
-    cc.run(cc.operator_parse(regular(src_to_baseformat(core_mr))))
+    cc.run(cc.operator_parse(src_to_baseformat(core_mr, keep_trivia=False)))
     patmatch_mr = get_src("patmatch.mrpy")
-    cc.run(cc.operator_parse(regular(src_to_baseformat(patmatch_mr))))
+    cc.run(cc.operator_parse(src_to_baseformat(patmatch_mr, keep_trivia=False)))
+
+
+def run_core_mr(cc: CompilerContext):
+    """Add the macros and operators of core.mrpy and patmatch.mrpy to cc.
+
+    They are compiled only once per process. A new context gets a copy of the
+    result, and a context that has already been used gets them compiled again.
+    """
+    global _core_context
+    if (cc.gensym_counter > 0 or cc.operators or cc.fun_defs[0]
+            or cc.meta.symbols or cc.meta.node_blocks):
+        _compile_core_mr(cc)
+        return
+    if _core_context is None:
+        core = CompilerContext(compile_mr)
+        _compile_core_mr(core)
+        _core_context = core
+    cc.copy_from(_core_context)
 
 
 def get_mr_meta_assignment(cc: CompilerContext) -> py.Assign | None:
@@ -53,6 +77,18 @@ def get_mr_meta_code(cc: CompilerContext) -> list[Node]:
     return syms
 
 
+def _nesting_error(e: RecursionError) -> Exception:
+    return Exception(f"Code is nested too deeply to compile: {e}")
+
+
+def compile_py(node: py.AST, filename: str, mode: str) -> CodeType:
+    """compile() for compiled Makrell, reporting code nested too deeply for Python as an error"""
+    try:
+        return compile(node, filename, mode)
+    except RecursionError as e:
+        raise _nesting_error(e) from None
+
+
 def nodes_to_module(nodes: list[Node], cc: CompilerContext | None = None,
                     filename: str | None = None,
                     run_core: bool = True) -> py.Module:
@@ -61,7 +97,11 @@ def nodes_to_module(nodes: list[Node], cc: CompilerContext | None = None,
     if run_core:
         run_core_mr(cc)
         cc.meta.node_blocks.clear()
-    pyast = flatten(compile_mr(Sequence(regular(nodes)), cc))
+    try:
+        pyast = flatten(compile_mr(Sequence(regular(nodes)), cc))
+    except RecursionError as e:
+        # lists, tuples and Python operators are compiled without recursion, but not all else is
+        raise _nesting_error(e) from None
     if cc.diag.has_errors():
         msg = '\n'.join(i.message for i in cc.diag.items)
         raise Exception(msg)
@@ -74,7 +114,7 @@ def nodes_to_module(nodes: list[Node], cc: CompilerContext | None = None,
         pyast.append(ass)
 
     m = py.Module(stmt_wrap(pyast, auto_return=False), type_ignores=[])
-    py.fix_missing_locations(m)
+    fix_missing_locations(m)
     return m
 
 
@@ -88,7 +128,10 @@ def eval_nodes(ns: list[Node], cc: CompilerContext | None = None,
         return None
     cc = cc or CompilerContext(compile_mr)
     run_core_mr(cc)
-    pyast = [compile_mr(n, cc) for n in ns]
+    try:
+        pyast = [compile_mr(n, cc) for n in ns]
+    except RecursionError as e:
+        raise _nesting_error(e) from None
     if not isinstance(pyast, list):
         pyast = [pyast]
     pyast = cc.fun_defs[0] + pyast
@@ -101,8 +144,8 @@ def eval_nodes(ns: list[Node], cc: CompilerContext | None = None,
     # statements
     if stmt_count > 0:
         body = py.Module(stmt_wrap([pa for pa in pyast[:stmt_count]], auto_return=False), [])
-        py.fix_missing_locations(body)
-        c = compile(body, "", mode="exec")
+        fix_missing_locations(body)
+        c = compile_py(body, "", mode="exec")
         exec(c, glob, loc)
 
     if not last_is_expr:
@@ -110,9 +153,9 @@ def eval_nodes(ns: list[Node], cc: CompilerContext | None = None,
 
     # return last node if expression
     last = pyast[-1]
-    py.fix_missing_locations(last)
+    fix_missing_locations(last)
     # print(py.unparse(last))
-    c = compile(py.Expression(last), "", mode="eval")
+    c = compile_py(py.Expression(last), "", mode="eval")
     r = eval(c, glob, loc)
     return r
 
@@ -124,7 +167,7 @@ def exec_nodes(nodes: list[Node], filename: str | None = None) -> Any:
         filename = "<string>"
     # TODO: cmd line option to print the generated code
     # print(py.unparse(m))
-    c = compile(m, filename, mode="exec")
+    c = compile_py(m, filename, mode="exec")
     glob = {}
     init_py = \
         """import sys
@@ -135,23 +178,94 @@ sys.path.append('.')
     return glob
 
 
-def src_to_module(src: str, diag: Diagnostics | None = None) -> py.Module:
-    parsed = src_to_baseformat(src, diag)
-    return nodes_to_module(regular(parsed))
+def src_to_module(src: str, diag: Diagnostics | None = None,
+                  cc: CompilerContext | None = None) -> py.Module:
+    parsed = src_to_baseformat(src, diag, keep_trivia=False)
+    return nodes_to_module(parsed, cc)
+
+
+def _python_name(name: str) -> str:
+    """A valid Python identifier for a name, such as $left, that compile() accepts but unparse can't emit"""
+    if name.isidentifier():
+        return name
+    return "_mr_" + "".join(ch if ch.isalnum() or ch == "_" else f"_{ord(ch):x}_" for ch in name)
+
+
+class _PythonNames(py.NodeTransformer):
+    def generic_visit(self, node: py.AST) -> py.AST:
+        for field in ("id", "arg", "name", "attr"):
+            value = getattr(node, field, None)
+            if isinstance(value, str) and not isinstance(node, py.alias):
+                setattr(node, field, _python_name(value))
+        if isinstance(node, (py.Global, py.Nonlocal)):
+            node.names = [_python_name(n) for n in node.names]
+        return super().generic_visit(node)
+
+
+def module_to_python(m: py.Module) -> tuple[str, list[int | None]]:
+    """Python source for a compiled module, and a line map.
+
+    The line map gives the line in the Makrell source of each line of the
+    Python source, or None where it is not known. It is found by parsing the
+    Python source again and pairing its nodes with those of m. Nodes with an
+    mr_comment attribute, such as the pass left by importm, get it as a comment.
+    """
+    m = _PythonNames().visit(copy.deepcopy(m))
+    code = py.unparse(m)
+    line_map: list[int | None] = [None] * (code.count("\n") + 1)
+    comments: dict[int, str] = {}
+    for generated, original in zip(py.walk(py.parse(code)), py.walk(m)):
+        if type(generated) is not type(original):
+            break
+        line = getattr(generated, "lineno", None)
+        src_line = getattr(original, "lineno", None)
+        if line is not None and src_line and line_map[line - 1] is None:
+            line_map[line - 1] = src_line
+        comment = getattr(original, "mr_comment", None)
+        if line is not None and comment is not None:
+            comments[line] = comment
+    if comments:
+        code_lines = code.split("\n")
+        for line, comment in comments.items():
+            code_lines[line - 1] += "  # " + comment
+        code = "\n".join(code_lines)
+    return code, line_map
+
+
+def src_to_python(src: str, filename: str | None = None) -> tuple[str, list[int | None]]:
+    """Compile Makrell source to Python source, with a line map as from module_to_python.
+
+    Includes are resolved relative to filename, and importm macros are run now,
+    so the Python source needs no Makrell compiler to run.
+    """
+    diag = Diagnostics()
+    parsed = src_to_baseformat(src, diag, keep_trivia=False)
+    if diag.has_errors():
+        raise Exception('\n'.join(i.message for i in diag.items))
+    if filename is not None:
+        parsed = include_includes(filename, parsed)
+    cc = CompilerContext(compile_mr)
+    m = nodes_to_module(regular(parsed), cc, filename=filename)
+    # Leave out the function definitions from the core, which its macros use at
+    # compile time. They are shared with the core context.
+    if _core_context is not None:
+        core_ids = {id(s) for s in _core_context.fun_defs[0]}
+        m.body = [s for s in m.body if id(s) not in core_ids]
+    return module_to_python(m)
 
 
 def eval_src(text: str,
              globals_: dict[str, Any] | None = None,
              locals_: dict[str, Any] | None = None
              ) -> Any:
-    parsed = src_to_baseformat(text)
-    opp = operator_parse(regular(parsed))
+    parsed = src_to_baseformat(text, keep_trivia=False)
+    opp = operator_parse(parsed)
     r = eval_nodes(opp, None, globals_, locals_)
     return r
 
 
 def exec_src(text: str, filename: str | None = None, globals_: dict[str, Any] | None = None) -> Any:
-    parsed = src_to_baseformat(text)
+    parsed = src_to_baseformat(text, keep_trivia=False)
     if filename is not None:
         parsed = include_includes(filename, parsed)
     return exec_nodes(regular(parsed), filename)
@@ -40,7 +40,7 @@ def parse_element(n: Node, parent: ET.Element | None = None, allow_exec: bool =
     next = reader.peek()
     if isinstance(next, SquareBrackets):
         reader.read()
-        attr_nodes = operator_parse(regular(next.nodes))
+        attr_nodes = operator_parse(next.regular_nodes)
         for attr_node in attr_nodes:
             if not isinstance(attr_node, BinOp) and not attr_node.type == "=":
                 raise Exception("Expected attribute")
@@ -118,12 +118,19 @@ def pyast_value(n: Node) -> py.AST | None:
 
 
 def flatten(a: list) -> list:
-    """recursively flatten a list"""
+    """flatten nested lists, to any depth"""
     if not isinstance(a, list):
         return [a]
     result = []
-    for x in a:
-        result.extend(flatten(x))
+    stack = [iter(a)]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, list):
+                stack.append(iter(x))
+                break
+            result.append(x)
+        else:
+            stack.pop()
     return result
 
 
@@ -1,89 +1,519 @@
+import typing as t
+from array import array
+from bisect import bisect_left
+import mmap as mmap_
+import os
+import re
+from sys import intern
+import time
 import regex
 from makrell.ast import (
-    BinOp, Comment, Identifier, LPar, Node, Operator, RPar, Sequence, String, Unknown, Whitespace, Number)
+    BinOp, Comment, Identifier, LineIndex, LPar, Node, Operator, RPar, Sequence, String, Unknown,
+    Whitespace, Number, fold_tree, pack_span, span_bits, trivia_types)
 
 
-rxs = [
-    (regex.compile(r'\s+', regex.MULTILINE), Whitespace),
-    (regex.compile(r'#.*$', regex.MULTILINE), Comment),
-    (regex.compile(r'/\*(.*?)\*/', regex.DOTALL), Comment),
+# Token classes in priority order. The first pattern that matches at a position wins.
+token_patterns = [
+    (r'\s+', regex.MULTILINE, Whitespace),
+    (r'#.*$', regex.MULTILINE, Comment),
+    (r'/\*(.*?)\*/', regex.DOTALL, Comment),
 
-    (regex.compile(r'[\p{L}_\$][\p{L}\p{N}_\$]*'), Identifier),
-    (regex.compile(r'("(?:\\.|[^"\\])*")([\p{L}\p{N}_]*)', regex.DOTALL), String),
-    (regex.compile(r'((?:-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?))([\p{L}\p{N}_]*)'), Number),
+    (r'[\p{L}_\$][\p{L}\p{N}_\$]*', 0, Identifier),
+    (r'("(?:\\.|[^"\\])*")([\p{L}\p{N}_]*)', regex.DOTALL, String),
+    (r'((?:-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?))([\p{L}\p{N}_]*)', 0, Number),
 
-    (regex.compile(r'[\(\[\{]'), LPar),
-    (regex.compile(r'[\)\]\}]'), RPar),
+    (r'[\(\[\{]', 0, LPar),
+    (r'[\)\]\}]', 0, RPar),
 
-    (regex.compile(r'[[\p{Sm}\p{So}\p{Pd}\p{Po}]--["\'#\$]]+', regex.VERSION1), Operator),
+    (r'[[\p{Sm}\p{So}\p{Pd}\p{Po}]--["\'#\$]]+', regex.VERSION1, Operator),
 
-    (regex.compile(r'[^"\'{}()\[\]\s]+'), Unknown),
+    (r'[^"\'{}()\[\]\s]+', 0, Unknown),
 ]
 
+rxs = [(regex.compile(pattern, flags), node_type) for pattern, flags, node_type in token_patterns]
+
+
+def _ascii_chars(char_class: str) -> str:
+    """The ASCII characters matched by a regex character class, as the body of a re set"""
+    rx = regex.compile(char_class, regex.VERSION1)
+    return "".join(re.escape(chr(c)) for c in range(128) if rx.fullmatch(chr(c)))
+
+
+_letters = _ascii_chars(r'\p{L}')
+_digits = _ascii_chars(r'\p{N}')
+_spaces = _ascii_chars(r'\s')
+_operator_chars = _ascii_chars(r'[[\p{Sm}\p{So}\p{Pd}\p{Po}]--["\'#\$]]')
+
+# token_patterns restricted to ASCII for the stdlib re engine, which is faster than
+# regex but lacks Unicode properties. Tokenises ASCII-only sources the same way.
+ascii_token_patterns = [
+    (rf'[{_spaces}]+', re.MULTILINE, Whitespace),
+    (r'#.*$', re.MULTILINE, Comment),
+    (r'/\*(.*?)\*/', re.DOTALL, Comment),
+
+    (rf'[{_letters}_\$][{_letters}{_digits}_\$]*', 0, Identifier),
+    (rf'("(?:\\.|[^"\\])*")([{_letters}{_digits}_]*)', re.DOTALL, String),
+    (rf'((?:-?[{_digits}]+(?:\.[{_digits}]+)?(?:[eE][-+]?[{_digits}]+)?))([{_letters}{_digits}_]*)', 0, Number),
+
+    (r'[\(\[\{]', 0, LPar),
+    (r'[\)\]\}]', 0, RPar),
+
+    (rf'[{_operator_chars}]+', 0, Operator),
+
+    (rf'[^"\'{{}}()\[\]{_spaces}]+', 0, Unknown),
+]
+
+
+def _scoped(pattern: str, flags: int) -> str:
+    """Wrap a pattern in inline flags so it keeps its meaning inside an alternation"""
+    inline = ""
+    if flags & regex.MULTILINE:
+        inline += "m"
+    if flags & regex.DOTALL:
+        inline += "s"
+    return f"(?{inline}:{pattern})" if inline else f"(?:{pattern})"
+
+
+def _master_rx(patterns: list, as_bytes: bool = False, ascii: bool = False) -> tuple[t.Any, list]:
+    """Combine token patterns into one alternation, one outer group per token class.
+
+    Returns the compiled pattern and a table mapping the outer group number
+    (`match.lastindex`) to the node type of that class. With ascii, the patterns
+    are compiled with re instead of regex.
+    """
+    engine, engine_flags = (re, re.ASCII) if ascii else (regex, regex.VERSION1)
+    alternatives = []
+    group_types = [None]
+    for pattern, flags, node_type in patterns:
+        alternatives.append("(" + _scoped(pattern, flags) + ")")
+        group_types.append(node_type)
+        group_types.extend([None] * engine.compile(pattern, flags).groups)
+    pattern = "|".join(alternatives)
+    rx = engine.compile(pattern.encode() if as_bytes else pattern, engine_flags)
+    return rx, group_types
+
+
+rx_token, token_group_types = _master_rx(token_patterns)
+# Used instead of rx_token for ASCII-only text. The group numbering is the same.
+rx_token_ascii, _ = _master_rx(ascii_token_patterns, ascii=True)
+# Matches ASCII-only UTF-8 data the same way rx_token matches the decoded text
+rx_token_bytes, _ = _master_rx(ascii_token_patterns, as_bytes=True, ascii=True)
+# Data that can't be tokenised as it is mapped: non-ASCII, or with \r to translate
+rx_non_ascii_or_cr_bytes = re.compile(rb'[\x80-\xff\r]')
+
+# Characters that must follow a match before it is known to be complete when
+# reading a stream, e.g. "1" may still become "1.5" or "1e+5".
+token_lookahead = 4
+
+# Node types of the token kinds stored in a TokenStream, indexed by kind
+token_kinds = [Whitespace, Comment, Identifier, String, Number, LPar, RPar, Operator, Unknown]
+_group_kinds = [None if nt is None else token_kinds.index(nt) for nt in token_group_types]
+_trivia_kinds = frozenset(token_kinds.index(nt) for nt in trivia_types)
+
+# The same tables with the trivia token classes mapped to None, for skipping them
+_regular_group_types = [None if nt in trivia_types else nt for nt in token_group_types]
+_regular_group_kinds = [None if k in _trivia_kinds else k for k in _group_kinds]
+
+KIND_IDENTIFIER = token_kinds.index(Identifier)
+KIND_STRING = token_kinds.index(String)
+KIND_NUMBER = token_kinds.index(Number)
+KIND_LPAR = token_kinds.index(LPar)
+KIND_RPAR = token_kinds.index(RPar)
+
+
+class TokenStream:
+    """Compact token list over a source string.
+
+    Token kinds, start and end offsets and the start of the suffix (for strings
+    and numbers) are kept in parallel arrays. Nodes are only created when a token
+    is accessed through indexing or iteration.
+
+    The source may also be ASCII-only bytes, such as a memory-mapped file, in
+    which case token text is decoded when it is accessed. A mapped file is closed
+    by close(), or at the end of a with statement, after which tokens can no
+    longer be accessed. Nodes already created stay valid.
+    """
+
+    def __init__(self, src: str | bytes | mmap_.mmap):
+        self.src = src
+        self.kinds = array('B')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.suffix_starts = array('q')
+        self._lines: LineIndex | None = None
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __enter__(self) -> 'TokenStream':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the source if it is a memory-mapped file, as from file_to_token_stream"""
+        if isinstance(self.src, mmap_.mmap):
+            self.src.close()
+
+    def __getitem__(self, i: int) -> Node:
+        node_type = token_kinds[self.kinds[i]]
+        start = self.starts[i]
+        end = self.ends[i]
+        if node_type is String or node_type is Number:
+            split = self.suffix_starts[i]
+            node = node_type(self.text(start, split), self.text(split, end))
+        elif node_type is Identifier or node_type is Operator:
+            node = node_type(intern(self.text(start, end)))
+        else:
+            node = node_type(self.text(start, end))
+        node._span = pack_span(start, end)
+        node._lines = self.lines
+        return node
+
+    def __iter__(self) -> t.Iterator[Node]:
+        for i in range(len(self.kinds)):
+            yield self[i]
+
+    def append(self, kind: int, start: int, end: int, suffix_start: int):
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.suffix_starts.append(suffix_start)
+
+    def text(self, start: int, end: int) -> str:
+        s = self.src[start:end]
+        return s if isinstance(s, str) else s.decode('ascii')
+
+    def value(self, i: int) -> str:
+        """Token text without any suffix"""
+        return self.text(self.starts[i], self.suffix_starts[i])
+
+    def suffix(self, i: int) -> str:
+        return self.text(self.suffix_starts[i], self.ends[i])
+
+    def regular(self) -> 'TokenStream':
+        """A stream over the same source without whitespace, comments and unknown tokens"""
+        r = TokenStream(self.src)
+        r._lines = self._lines
+        trivia = _trivia_kinds
+        for i, kind in enumerate(self.kinds):
+            if kind not in trivia:
+                r.append(kind, self.starts[i], self.ends[i], self.suffix_starts[i])
+        return r
+
+    @property
+    def lines(self) -> LineIndex:
+        if self._lines is None:
+            self._lines = LineIndex.from_src(self.src)
+        return self._lines
+
 
 def is_regular_node(n: Node) -> bool:
-    return not isinstance(n, (Comment, Whitespace, Unknown))
+    return not isinstance(n, trivia_types)
 
 
 def regular(nodes: list[Node], recurse: bool = False) -> list[Node]:
-    def r(n) -> Node:
+    if isinstance(nodes, TokenStream):
+        return nodes.regular()  # type: ignore
+    if isinstance(nodes, Sequence) and not recurse:
+        return list(nodes.regular_nodes)
+
+    def children(n: Node) -> list[Node] | None:
+        if isinstance(n, Sequence):
+            return [ni for ni in n.nodes if is_regular_node(ni)]
+        if isinstance(n, BinOp):
+            return [n.left, n.right]
+        return None
+
+    def combine(n: Node, children: list[Node]) -> Node:
         if isinstance(n, Sequence):
-            children = regular(n.nodes, True)
             return type(n)(children)
         if isinstance(n, BinOp):
-            left = r(n.left)
-            right = r(n.right)
-            return BinOp(left, n.op, right)
+            return BinOp(children[0], n.op, children[1])
         return n
 
     if recurse:
-        return [r(n) for n in nodes if is_regular_node(n)]
+        return [fold_tree(n, children, combine) for n in nodes if is_regular_node(n)]
     else:
         return [n for n in nodes if is_regular_node(n)]
 
 
-def src_to_tokens(src: str) -> list[Node]:
+def _token_rx(src: str) -> t.Any:
+    """The master pattern to tokenise src with, the faster ASCII one if possible"""
+    return rx_token_ascii if src.isascii() else rx_token
+
+
+def _make_token(node_type: type, m: t.Any, group: int, start: int, end: int, lines: LineIndex) -> Node:
+    """The node for a token matched by group of a master pattern, at [start, end)"""
+    if node_type is String or node_type is Number:
+        node = node_type(m.group(group + 1), m.group(group + 2))
+    elif node_type is Identifier or node_type is Operator:
+        node = node_type(intern(m.group(group)))
+    else:
+        node = node_type(m.group(group))
+    node._span = ((start + 1) << span_bits) | (end + 1)
+    node._lines = lines
+    return node
+
+
+def src_to_tokens(src: str, keep_trivia: bool = True) -> list[Node]:
+    """Tokenise src into a list of nodes.
+
+    Identifier and operator values are interned, since the same few names occur
+    over and over, so their strings are shared and compare by identity. Without
+    keep_trivia, whitespace, comments and unknown tokens are skipped.
+    """
     nodes = []
+    append = nodes.append
+    make_token = _make_token
+    match = _token_rx(src).match
+    group_types = token_group_types if keep_trivia else _regular_group_types
+    lines = LineIndex.from_src(src)
     pos = 0
-    line = 1
-    column = 1
-
-    while pos < len(src):
-        match = None
-        for rx, node_type in rxs:
-            match = rx.match(src, pos)
-            if match:
-                if node_type in {String, Number}:
-                    value = match.group(1)
-                    suffix = match.group(2)
-                    node = node_type(value, suffix)
-                else:
-                    value = match.group()
-                    node = node_type(value)
-                nodes.append(node)
-
-                node._start_line = line
-                node._start_column = column
-                
-                pos += len(match.group())
-                line_increment = value.count('\n')
-                if line_increment > 0:
-                    line += line_increment
-                    column = len(value) - value.rfind('\n')
-                else:
-                    column += len(value)
-
-                node._end_line = line
-                node._end_column = column
-                break
+    end = len(src)
 
-        if not match:
+    while pos < end:
+        m = match(src, pos)
+        if m is None:
+            line, column = lines.line_column(pos)
             raise ValueError(f"Unrecognized character sequence at {line}:{column}")
-    
+        group = m.lastindex
+        node_type = group_types[group]
+        token_end = m.end()
+        if node_type is not None:
+            append(make_token(node_type, m, group, pos, token_end, lines))
+        pos = token_end
+
     return nodes
 
 
+def _token_end(n: Node) -> int:
+    return n._end
+
+
+def retokenise(tokens: list[Node], src: str, start: int, end: int, new_end: int) -> list[Node]:
+    """Update a token list after an edit, rescanning only the affected part.
+
+    The text at [start, end) of the source the tokens came from has been replaced,
+    giving src, where the replacement is src[start:new_end]. Scanning restarts at
+    a token boundary safely before the edit and stops as soon as a new token starts
+    where an old token after the edit started, since tokenising from there on gives
+    the same result. The tokens after that point are reused with shifted offsets.
+    The tokens and their line index are updated in place, unless the new source
+    fails to tokenise.
+    """
+    if not tokens:
+        return src_to_tokens(src)
+    lines = tokens[0]._lines
+    assert lines is not None
+    delta = new_end - end
+
+    # restart before any token whose match may have looked at the edited text
+    i = bisect_left(tokens, start - token_lookahead + 1, key=_token_end)
+    i = max(i - 1, 0)
+    # An unterminated /* is an operator token, but the comment pattern tried at
+    # its start looks arbitrarily far ahead. Only an edit that makes a */ can
+    # terminate it, and then scanning restarts before the first one.
+    # (Unterminated strings don't tokenise at all.)
+    if src.find("*/", max(start - 1, 0), new_end + 1) >= 0 and src.find("/*", 0, tokens[i]._start) >= 0:
+        for k in range(i):
+            n = tokens[k]
+            if not isinstance(n, Comment) and str(n).startswith("/*"):
+                i = k
+                break
+    # first old token after the edit
+    j = i
+    while j < len(tokens) and tokens[j]._start < end:
+        j += 1
+
+    match = _token_rx(src).match
+    group_types = token_group_types
+    rescanned = []
+    pos = tokens[i]._start
+    src_end = len(src)
+    while pos < src_end:
+        if pos >= new_end:
+            old_pos = pos - delta
+            while j < len(tokens) and tokens[j]._start < old_pos:
+                j += 1
+            if j < len(tokens) and tokens[j]._start == old_pos:
+                break
+        m = match(src, pos)
+        if m is None:
+            line, column = LineIndex.from_src(src).line_column(pos)
+            raise ValueError(f"Unrecognized character sequence at {line}:{column}")
+        group = m.lastindex
+        token_end = m.end()
+        rescanned.append(_make_token(group_types[group], m, group, pos, token_end, lines))
+        pos = token_end
+    else:
+        j = len(tokens)
+
+    lines.update(src, start, end, new_end)
+    following = tokens[j:]
+    if delta:
+        shift = (delta << span_bits) + delta
+        for n in following:
+            n._span += shift
+    return tokens[:i] + rescanned + following
+
+
+def token_at(tokens: list[Node], offset: int) -> Node | None:
+    """The token covering a source offset, found by bisecting a token list in source order"""
+    lo = 0
+    hi = len(tokens)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if tokens[mid]._end <= offset:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(tokens) and tokens[lo]._start <= offset:
+        return tokens[lo]
+    return None
+
+
+def src_to_token_stream(src: str | bytes | mmap_.mmap, keep_trivia: bool = True) -> TokenStream:
+    """Tokenise into a compact TokenStream instead of a list of nodes.
+
+    src may also be bytes-like, but must then be ASCII-only. Without keep_trivia,
+    whitespace, comments and unknown tokens are skipped.
+    """
+    stream = TokenStream(src)
+    kinds = stream.kinds.append
+    starts = stream.starts.append
+    ends = stream.ends.append
+    suffix_starts = stream.suffix_starts.append
+    match = _token_rx(src).match if isinstance(src, str) else rx_token_bytes.match
+    group_kinds = _group_kinds if keep_trivia else _regular_group_kinds
+    pos = 0
+    end = len(src)
+
+    while pos < end:
+        m = match(src, pos)
+        if m is None:
+            line, column = stream.lines.line_column(pos)
+            raise ValueError(f"Unrecognized character sequence at {line}:{column}")
+        group = m.lastindex
+        kind = group_kinds[group]
+        token_end = m.end()
+        if kind is None:
+            pos = token_end
+            continue
+        kinds(kind)
+        starts(pos)
+        ends(token_end)
+        if kind == KIND_STRING or kind == KIND_NUMBER:
+            suffix_starts(m.start(group + 2))
+        else:
+            suffix_starts(token_end)
+        pos = token_end
+
+    return stream
+
+
 def file_to_tokens(path: str) -> list[Node]:
+    """Tokenise a UTF-8 file, with newlines translated to \\n as by open()"""
     with open(path, 'r', encoding='utf-8') as f:
         src = f.read()
     return src_to_tokens(src)
+
+
+def file_to_token_stream(path: str) -> TokenStream:
+    """Tokenise a memory-mapped UTF-8 file into a TokenStream.
+
+    An ASCII-only file with \\n newlines is tokenised directly over the mapping,
+    so the text is paged in by the OS and never copied as a whole. Other files
+    are decoded from the mapping first, and newlines are translated to \\n as by
+    open(), so the tokens are the same as from file_to_tokens.
+
+    The returned stream owns the mapping and should be closed when done with,
+    as in `with file_to_token_stream(path) as tokens: ...`.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return src_to_token_stream("")
+        mapped = mmap_.mmap(f.fileno(), 0, access=mmap_.ACCESS_READ)
+    if rx_non_ascii_or_cr_bytes.search(mapped) is None:
+        try:
+            return src_to_token_stream(mapped)
+        except BaseException:
+            mapped.close()
+            raise
+    try:
+        src = str(mapped, 'utf-8')
+    finally:
+        mapped.close()
+    if "\r" in src:
+        src = src.replace("\r\n", "\n").replace("\r", "\n")
+    return src_to_token_stream(src)
+
+
+def _token_complete(m: t.Any, buf: str) -> bool:
+    """Whether a token matched near the end of buf is the same whatever text follows"""
+    node_type = token_group_types[m.lastindex]
+    if node_type is LPar or node_type is RPar or (node_type is Comment and buf.startswith("/*", m.start())):
+        return True
+    token_end = m.end()
+    if token_end == len(buf):
+        return False
+    # The next character ends the token, except that 1. and 1e+ may go on as 1.5 and 1e+5
+    return node_type is not Number or buf[token_end] not in ".+-"
+
+
+def iter_tokens(fileobj: t.TextIO, chunk_size: int = 65536, follow: bool = False,
+                poll_interval: float = 0.5) -> t.Iterator[Node]:
+    """Tokenise a text stream, reading it in chunks and yielding tokens as soon as they are complete.
+
+    A token at the end of what has been read is yielded once the next character
+    shows that it can't go on, or right away for brackets. Streams that aren't
+    seekable, such as pipes, are read a line at a time, since reading a whole
+    chunk would wait for the chunk to fill. With follow, an empty read doesn't
+    end the stream, which is read again after poll_interval seconds, as by
+    tail -f, so the iterator never ends.
+    """
+    match = rx_token_ascii.match
+    group_types = token_group_types
+    seekable = getattr(fileobj, "seekable", None)
+    read = fileobj.read if seekable is not None and seekable() else fileobj.readline
+    buf = ""
+    base = 0  # stream offset of buf[0]
+    lines = LineIndex.from_src(buf)
+    pos = 0
+    eof = False
+    read_size = chunk_size
+
+    while True:
+        end = len(buf)
+        if pos >= end and eof:
+            return
+        m = match(buf, pos) if pos < end else None
+        if not eof and (m is None
+                        or (m.end() + token_lookahead > end and not _token_complete(m, buf))
+                        or (buf.startswith("/*", pos) and buf.find("*/", pos + 2) < 0)):
+            # the token may continue in the next chunk
+            chunk = read(read_size)
+            if chunk:
+                line, column = lines.line_column(base + pos)
+                base += pos
+                buf = buf[pos:] + chunk
+                pos = 0
+                lines = LineIndex.from_src(buf, base, line, base - column + 1)
+                match = _token_rx(buf).match
+                read_size *= 2  # grow while a single token spans several chunks
+            elif follow:
+                time.sleep(poll_interval)
+            else:
+                eof = True
+            continue
+        if m is None:
+            line, column = lines.line_column(base + pos)
+            raise ValueError(f"Unrecognized character sequence at {line}:{column}")
+        read_size = chunk_size
+
+        group = m.lastindex
+        token_end = m.end()
+        node = _make_token(group_types[group], m, group, base + pos, base + token_end, lines)
+        pos = token_end
+        yield node
@@ -1,7 +1,11 @@
 
 from datetime import datetime
 from typing import Any
-from makrell.makrellpy.compiler import eval_src
+import pytest
+from makrell.baseformat import Associativity, src_to_baseformat
+from makrell.makrellpy._compile import compile_mr
+from makrell.makrellpy._compiler_common import CompilerContext
+from makrell.makrellpy.compiler import eval_src, run_core_mr
 
 
 def run(src: str, expected: Any) -> None:
@@ -109,6 +113,99 @@ def test_logical() -> None:
     run("{not [2]}", False)
 
 
+def test_operator_parse_cache() -> None:
+    cc = CompilerContext(compile_mr)
+    [n] = src_to_baseformat("(a + b * c)")
+    parsed = cc.operator_parse_node(n)
+    assert repr(parsed) == "[BO:<ID:a + BO:<ID:b * ID:c>>]"
+    assert cc.operator_parse_node(n) is parsed
+    cc.define_operator("+", 130, Associativity.LEFT)
+    assert repr(cc.operator_parse_node(n)) == "[BO:<BO:<ID:a + ID:b> * ID:c>]"
+    assert repr(CompilerContext(compile_mr).operator_parse_node(n)) == repr(parsed)
+
+
+def test_core_context_copies() -> None:
+    cc1 = CompilerContext(compile_mr)
+    run_core_mr(cc1)
+    cc2 = CompilerContext(compile_mr)
+    run_core_mr(cc2)
+    assert cc1.operators == cc2.operators and ">>" in cc1.operators
+    assert cc1.meta.symbols.keys() == cc2.meta.symbols.keys()
+    match1 = cc1.meta.symbols["match"]
+    assert match1.__globals__ is cc1.meta.globals
+    assert cc1.meta.globals["_match_pattern_types"] is not cc2.meta.globals["_match_pattern_types"]
+    assert cc1.meta.globals["$context"] is cc1
+
+    cc1.define_operator("<=>", 50, Associativity.LEFT)
+    cc1.meta.globals["_match_pattern_types"].clear()
+    assert "<=>" not in cc2.operators
+    assert len(cc2.meta.globals["_match_pattern_types"]) > 0
+    assert eval_src("{match 2 _:int true}") is True
+
+
+def test_meta_copy_closures() -> None:
+    cc1 = CompilerContext(compile_mr)
+    exec("""
+seen = set()
+def counter():
+    counts = []
+    def bump():
+        counts.append(1)
+        return len(counts), bump
+    return bump
+bump = counter()
+def add_seen(x, s=seen):
+    s.add(x)
+    return len(s)
+def context():
+    return globals()['$context']
+def context_of(f=context):
+    return f()
+""", cc1.meta.globals)
+    cc2 = CompilerContext(compile_mr)
+    cc2.meta.copy_from(cc1.meta)
+    g2 = cc2.meta.globals
+    assert g2["bump"]() == (1, g2["bump"])
+    assert g2["add_seen"](1) == 1 and g2["seen"] == {1}
+    assert g2["context_of"]() is cc2
+
+    # what was done in the copy is not seen in the original or another copy
+    cc3 = CompilerContext(compile_mr)
+    cc3.meta.copy_from(cc1.meta)
+    for g in (cc1.meta.globals, cc3.meta.globals):
+        assert g["seen"] == set()
+        assert g["bump"]()[0] == 1
+        assert g["add_seen"](2) == 1
+    assert cc3.meta.globals["context_of"]() is cc3
+
+    # the same for the core, from the meta code of one compile to the next
+    assert eval_src("{meta {_match_pattern_types.clear}} 1") == 1
+    assert eval_src("{match 2 _:int true}") is True
+
+
+def test_quote_deep() -> None:
+    cc = CompilerContext(compile_mr)
+    [n] = src_to_baseformat("(" * 3000 + "a" + ")" * 3000)
+    q = cc.meta.quote(n)
+    for _ in range(3000):
+        assert q.nodes[0].value == "RoundBrackets"
+        [q] = q.nodes[1].nodes
+    assert repr(q) == 'CB:{ID:Identifier S:"a"}'
+
+
+def test_compile_deep() -> None:
+    # beyond the recursion limit for compile_mr, up to where compile() itself stops
+    depth = 800
+    r = eval_src("[" * depth + "1" + "]" * depth)
+    for _ in range(depth):
+        [r] = r
+    assert r == 1
+    run(" + ".join(["1"] * depth), depth)
+    run("(" * 5000 + "2" + ")" * 5000, 2)
+    with pytest.raises(Exception, match="nested too deeply"):
+        eval_src("[" * 20000 + "]" * 20000)
+
+
 # def test_bitwise() -> None:
 #     run("2 &&& 3", 2 & 3)
 #     run("2 ||| 3", 2 | 3)
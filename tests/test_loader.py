@@ -0,0 +1,180 @@
+import importlib
+import json
+import marshal
+import importlib.util
+import os
+import py_compile
+import sys
+import pytest
+import makrell
+import makrell.makrellpy.compiler as mrpy_compiler
+from makrell import cli
+from makrell.build import build_py
+from makrell.compileall import compile_dir
+
+
+@pytest.fixture
+def mr_package(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    yield tmp_path
+    for name in [m for m in sys.modules if m.startswith("mrpkg_")]:
+        del sys.modules[name]
+
+
+def import_fresh(name):
+    sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    return importlib.import_module(name)
+
+
+def test_bytecode_cache(mr_package, monkeypatch):
+    src_path = mr_package / "mrpkg_a.mr"
+    src_path.write_text("x = 2 + 3\n", encoding="utf-8")
+    assert import_fresh("mrpkg_a").x == 5
+    pyc = makrell._bytecode_path(str(src_path))
+    data = open(pyc, "rb").read()
+    assert data[:4] == importlib.util.MAGIC_NUMBER
+    assert int.from_bytes(data[4:8], "little") == 0b11
+
+    compiled = []
+    src_to_module = mrpy_compiler.src_to_module
+    monkeypatch.setattr(mrpy_compiler, "src_to_module",
+                        lambda src, **kw: compiled.append(src) or src_to_module(src, **kw))
+    assert import_fresh("mrpkg_a").x == 5
+    assert compiled == []
+
+    src_path.write_text("x = 2 + 4\n", encoding="utf-8")
+    assert import_fresh("mrpkg_a").x == 6
+    assert len(compiled) == 1
+    assert open(pyc, "rb").read() != data
+
+
+def test_bytecode_cache_importm(mr_package):
+    # the macros are not in the source, so a bytecode file would go stale when they change
+    mac_path = mr_package / "mrpkg_mac.mr"
+    mac_path.write_text("{def macro n [ns]\n    {quote 10}\n}\n", encoding="utf-8")
+    use_path = mr_package / "mrpkg_use.mr"
+    use_path.write_text("{importm mrpkg_mac@[n]}\nv = {n}\n", encoding="utf-8")
+    assert import_fresh("mrpkg_use").v == 10
+    assert not os.path.exists(makrell._bytecode_path(str(use_path)))
+    assert os.path.exists(makrell._bytecode_path(str(mac_path)))
+
+    mac_path.write_text("{def macro n [ns]\n    {quote 20}\n}\n", encoding="utf-8")
+    sys.modules.pop("mrpkg_mac")
+    assert import_fresh("mrpkg_use").v == 20
+    assert compile_dir(str(mr_package), workers=1) == [
+        (str(mac_path), False, None), (str(use_path), True, None)]
+    assert not os.path.exists(makrell._bytecode_path(str(use_path)))
+
+
+def test_bytecode_beside_py(mr_package):
+    # the .py is imported, but a .mr beside it may still be compiled, e.g. by compileall
+    mr_path = mr_package / "mrpkg_same.mr"
+    py_path = mr_package / "mrpkg_same.py"
+    mr_path.write_text("x = 1\n", encoding="utf-8")
+    py_path.write_text("x = 2\n", encoding="utf-8")
+    py_compile.compile(str(py_path))
+    assert compile_dir(str(mr_package), workers=1) == [(str(mr_path), True, None)]
+    mr_pyc = makrell._bytecode_path(str(mr_path))
+    py_pyc = importlib.util.cache_from_source(str(py_path))
+    assert mr_pyc != py_pyc
+    for pyc, x in ((mr_pyc, 1), (py_pyc, 2)):
+        glob = {}
+        exec(marshal.loads(open(pyc, "rb").read()[16:]), glob)
+        assert glob["x"] == x
+    assert import_fresh("mrpkg_same").x == 2
+
+
+def test_dont_write_bytecode(mr_package, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", True)
+    src_path = mr_package / "mrpkg_b.mr"
+    src_path.write_text("y = 7\n", encoding="utf-8")
+    assert import_fresh("mrpkg_b").y == 7
+    assert not (mr_package / "__pycache__").exists()
+    loader = makrell.MakrellLoader("mrpkg_b", str(src_path))
+    assert loader.path_stats(str(src_path))["size"] == len("y = 7\n")
+
+
+def test_finder_listing_cache(mr_package):
+    finder = makrell.MakrellFinder()
+    path = [str(mr_package)]
+    assert finder.find_spec("mrpkg_c", path) is None
+    assert path == [str(mr_package)]
+
+    (mr_package / "mrpkg_c.mr").write_text("z = 1\n", encoding="utf-8")
+    spec = finder.find_spec("mrpkg_c", path)
+    assert spec is not None and spec.origin == str(mr_package / "mrpkg_c.mr")
+
+    # a stale listing, as when a directory changes within the mtime resolution
+    mtime = os.stat(mr_package).st_mtime_ns
+    finder._listings[str(mr_package)] = (mtime, frozenset())
+    assert finder.find_spec("mrpkg_c", path) is None
+    finder.invalidate_caches()
+    assert finder.find_spec("mrpkg_c", path) is not None
+
+    (mr_package / "mrpkg_d").mkdir()
+    (mr_package / "mrpkg_d" / "__init__.mr").write_text("w = 1\n", encoding="utf-8")
+    spec = finder.find_spec("mrpkg_d", None)
+    assert spec is not None and spec.submodule_search_locations is not None
+
+
+def test_compile_dir(mr_package, monkeypatch):
+    (mr_package / "sub").mkdir()
+    (mr_package / "mrpkg_e.mr").write_text("v = 3\n", encoding="utf-8")
+    (mr_package / "sub" / "ok.mr").write_text("v = 4\n", encoding="utf-8")
+    (mr_package / "sub" / "bad.mr").write_text("[a, b]\n", encoding="utf-8")
+
+    results = compile_dir(str(mr_package), workers=2)
+    assert [(os.path.relpath(p, mr_package), compiled) for p, compiled, _ in results] == [
+        ("mrpkg_e.mr", True), (os.path.join("sub", "bad.mr"), False), (os.path.join("sub", "ok.mr"), True)]
+    assert "Unknown operator" in results[1][2]
+    assert [r[1] for r in compile_dir(str(mr_package), workers=1)] == [False, False, False]
+
+    monkeypatch.setattr(mrpy_compiler, "src_to_module", None)
+    assert import_fresh("mrpkg_e").v == 3
+
+
+def test_cli_workers(mr_package, capsys):
+    (mr_package / "mrpkg_f.mr").write_text("v = 5\n", encoding="utf-8")
+    assert cli.compileall([str(mr_package), "-j", "1"]) == 0
+    assert cli.compileall(["-j0", str(mr_package)]) == 0
+    assert cli.build([str(mr_package / "mrpkg_f.mr"), "-j", "2", "--emit-py", str(mr_package / "f.py")]) == 0
+    assert capsys.readouterr().out.splitlines() == [
+        "1 compiled, 0 up to date, 0 failed", "0 compiled, 1 up to date, 0 failed", "1 built, 0 failed"]
+    for args in (["-j", "x", "."], ["-j", "-1", "."], ["-j"]):
+        with pytest.raises(SystemExit) as e:
+            cli.compileall(args)
+        assert e.value.code == 2
+    assert "invalid number of workers: 'x'" in capsys.readouterr().err
+    with pytest.raises(SystemExit):
+        cli.build(["-j", "2", "src", "out"])
+    assert "--emit-py" in capsys.readouterr().err
+
+
+def test_build_py(mr_package):
+    (mr_package / "mrpkg_mac2.mr").write_text("{def macro ten [ns]\n    {quote 10}\n}\n", encoding="utf-8")
+    src_dir = mr_package / "src"
+    (src_dir / "pkg").mkdir(parents=True)
+    (src_dir / "pkg" / "m.mr").write_text(
+        '{fun f [x] x + 1}\n\ny = [1 2] | {map {+ 2} _} | list\nz = {match 3 _:int "int" _ "other"}\n'
+        '{importm mrpkg_mac2@[ten]}\nt = {ten}\n',
+        encoding="utf-8")
+    (src_dir / "bad.mr").write_text("[a, b]\n", encoding="utf-8")
+    out_dir = mr_package / "out"
+
+    results = build_py(str(src_dir), str(out_dir), workers=1)
+    assert [(os.path.basename(p), e is None) for p, e in results] == [("bad.mr", False), ("m.mr", True)]
+    code = (out_dir / "pkg" / "m.py").read_text(encoding="utf-8")
+    glob: dict = {}
+    exec(code, glob)
+    assert (glob["f"](1), glob["y"], glob["z"], glob["t"]) == (2, [3, 4], "int", 10)
+    # only the module's own code, not the functions the core macros use
+    assert "pattype" not in code
+    assert "pass  # macros run at compile time: mrpkg_mac2@[ten]" in code.splitlines()
+
+    line_map = json.loads((out_dir / "pkg" / "m.py.map").read_text(encoding="utf-8"))
+    assert line_map["source"] == os.path.join("..", "..", "src", "pkg", "m.mr")
+    mapped = {line: src_line for line, src_line in zip(code.splitlines(), line_map["lines"])}
+    assert (mapped["def f(x):"], mapped["    return x + 1"]) == (1, 1)
+    assert [src_line for line, src_line in mapped.items() if line.startswith(("y =", "z =", "t ="))] == [3, 4, 6]
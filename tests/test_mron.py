@@ -1,5 +1,7 @@
 from datetime import datetime
+from makrell.baseformat import src_to_baseformat
 from makrell.mron import parse_src
+from makrell._mron_py import parse_token
 
 
 def test_empty():
@@ -146,3 +148,40 @@ def test_exec():
         "b": 5,
     }
     assert actual == expected
+
+
+def test_exec_root_only():
+    # {$ ...} is only evaluated at the root level, elsewhere it is an object
+    assert parse_src("[{$ 1}]", allow_exec=True) == [{"$": 1}]
+    assert parse_src("{$ 2 + 3}", allow_exec=True) == 5
+    assert parse_src("{$ 2}") == {"$": 2}
+    [n] = src_to_baseformat("{a {$ 1}}")
+    assert parse_token(n, True) == {"a": {"$": 1}}
+    # trivia in the root {$ ...} doesn't stop it being evaluated
+    [n] = src_to_baseformat("{ $ 2 + 3 }")
+    assert parse_token(n, True) == 5
+
+
+def test_unmatched_bracket():
+    # an unclosed root level bracket is left out, as when parsing a node tree
+    assert parse_src("a {b 2") == "a"
+    assert parse_src("{a 1} [b {$ 2}", allow_exec=True) == {"a": 1}
+    assert parse_src("a {$ 1") == "a"
+    assert parse_src("[1 [2") is None
+    for src in ["a [2 3}", "a 1}"]:
+        try:
+            parse_src(src)
+            assert False
+        except Exception as e:
+            assert "Unmatched" in str(e)
+
+
+def test_deep_nesting():
+    depth = 5000
+    src = "a " + "[1 " * depth + "{b 2 c 5}" + "]" * depth
+    for actual in [parse_src(src, allow_exec=True), parse_token(src_to_baseformat("{" + src + "}")[0], True)]:
+        v = actual["a"]
+        for _ in range(depth):
+            assert v[0] == 1
+            v = v[1]
+        assert v == {"b": 2, "c": 5}
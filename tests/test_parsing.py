@@ -1,5 +1,15 @@
-
-from makrell.parsing import flatten
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import pytest
+from makrell import _baseformat_cache
+from makrell.ast import Identifier
+from makrell.baseformat import (
+    Associativity, OperatorTable, ParseError, cached_file_to_baseformat, e_string_parts, file_to_baseformat,
+    include_includes, iter_baseformat, operator_parse,
+    src_to_baseformat, src_to_baseformat_parallel, top_level_splits)
+from makrell.parsing import Diagnostics, flatten
+from makrell.tokeniser import regular
 
 
 def test_flatten():
@@ -9,3 +19,223 @@ def test_flatten():
     assert flatten([1, [2, [3, 4]]]) == [1, 2, 3, 4]
     assert flatten([1, [2, [3, 4], 5]]) == [1, 2, 3, 4, 5]
     assert flatten([1, [2, [3, 4], 5], 6]) == [1, 2, 3, 4, 5, 6]
+    deep: list = [1]
+    for i in range(2, 10000):
+        deep = [deep, i, []]
+    assert flatten(deep) == list(range(1, 10000))
+
+
+def test_top_level_splits():
+    src = '{a "}" b}\n# (\n[c /* ] */ d] (e)'
+    assert top_level_splits(src, 1) == [9, 27]
+    assert top_level_splits(src, 100) == []
+
+
+def test_src_to_baseformat_parallel():
+    src = '{fun f [x]\n    x + 1}\n"{" # }\n{f 2}\n[1 2\n 3] (a b)\n' * 5
+
+    def positions(ns):
+        return [(str(n), n.start_pos(), n.end_pos(), positions(getattr(n, "nodes", []))) for n in ns]
+
+    expected = src_to_baseformat(src)
+    parsed = src_to_baseformat_parallel(src, workers=2, chunk_size=20)
+    assert parsed == expected
+    assert positions(parsed) == positions(expected)
+
+
+def test_nodes_to_baseformat_nesting():
+    [b] = src_to_baseformat('{a [b (c "x{1}"e)]}')
+    assert [type(n).__name__ for n in b.nodes] == ["Identifier", "Whitespace", "SquareBrackets"]
+    sb = b.nodes[2]
+    rb = sb.nodes[2]
+    assert rb.nodes[2] is rb._original_nodes[2]
+    assert str(rb.nodes[2]) == '"x{1}"e'
+    assert str(b) == '{a [b (c "x{1}"e)]}'
+    assert (sb.start_pos(), sb.end_pos()) == ((1, 4), (1, 19))
+
+
+def test_iter_baseformat():
+    def key(ns):
+        return [(repr(n), n._start, n._end, n.start_pos(), str(n)) for n in ns]
+
+    src = '{event 1 [a "x{"]} # c\n{event 2 (b)}\n  {event 3}'
+    for chunk_size in (1, 5, 1000):
+        assert key(iter_baseformat(io.StringIO(src), chunk_size=chunk_size)) == key(src_to_baseformat(src))
+    assert key(iter_baseformat(io.StringIO(src), keep_trivia=False)) == key(src_to_baseformat(src, keep_trivia=False))
+
+    f = io.StringIO(src * 1000)
+    forms = iter_baseformat(f, chunk_size=100)
+    assert repr(next(forms)) == 'CB:{ID:event WS N:1 WS SB:[ID:a WS S:"x{"]}'
+    assert f.tell() < 1000
+
+    diag = Diagnostics()
+    assert len(list(iter_baseformat(io.StringIO("{a} {b"), diag))) == 2
+    assert diag.has_errors()
+
+
+def test_iter_baseformat_pipe(tmp_path):
+    # a form is yielded when its bracket closes, while the writer is still going
+    r, w = os.pipe()
+    with os.fdopen(r, encoding="utf-8") as reader, ThreadPoolExecutor(1) as executor:
+        forms = iter_baseformat(reader, keep_trivia=False)
+        try:
+            for i in range(3):
+                os.write(w, f"{{event a {i}}}\n".encode())
+                assert repr(executor.submit(next, forms).result(timeout=5)) == f"CB:{{ID:event ID:a N:{i}}}"
+        finally:
+            os.close(w)
+        assert list(forms) == []
+
+    path = tmp_path / "log.mr"
+    path.write_text("{event 1}\n{event", encoding="utf-8")
+    with open(path, encoding="utf-8") as reader, open(path, "a", encoding="utf-8") as writer:
+        forms = iter_baseformat(reader, keep_trivia=False, follow=True, poll_interval=0)
+        assert repr(next(forms)) == "CB:{ID:event N:1}"
+        writer.write(" 2}\n")
+        writer.flush()
+        assert repr(next(forms)) == "CB:{ID:event N:2}"
+
+
+def test_regular_nodes():
+    [b] = src_to_baseformat('{a # c\n b}')
+    regular_nodes = b.regular_nodes
+    assert [n.value for n in regular_nodes] == ["a", "b"]
+    assert b.regular_nodes is regular_nodes
+    b.nodes.append(Identifier("c"))
+    assert [n.value for n in b.regular_nodes] == ["a", "b", "c"]
+    b.nodes = b.nodes[:1]
+    assert [n.value for n in b.regular_nodes] == ["a"]
+
+
+def test_regular_nodes_item_assignment():
+    from makrell.makrellpy.compiler import CompilerContext, compile_mr
+    [b] = src_to_baseformat('{a + b}')
+    cc = CompilerContext(compile_mr)
+    assert repr(cc.operator_parse_node(b)) == "[BO:<ID:a + ID:b>]"
+    b.nodes[-1] = Identifier("c")
+    b.invalidate()
+    assert [n.value for n in b.regular_nodes] == ["a", "+", "c"]
+    assert repr(cc.operator_parse_node(b)) == "[BO:<ID:a + ID:c>]"
+
+
+def test_regular_recurse():
+    [b] = regular(src_to_baseformat("{a [b # c\n (c)] }"), True)
+    assert repr(b) == "CB:{ID:a SB:[ID:b RB:(ID:c)]}"
+    [b] = regular(src_to_baseformat("[ " * 5000 + "x" + "]" * 5000), True)
+    for _ in range(4999):
+        [b] = b.nodes
+    assert repr(b) == "SB:[ID:x]"
+
+
+def test_operator_parse():
+    def parse(src, *args):
+        return repr(operator_parse(src_to_baseformat(src)[0].regular_nodes, *args))
+
+    assert parse("(a = b = c | f | g)") == "[BO:<ID:a = BO:<ID:b = BO:<BO:<ID:c | ID:f> | ID:g>>>]"
+    assert parse("(a \\ b | c)") == "[BO:<ID:a \\ BO:<ID:b | ID:c>>]"
+    assert parse("(a | b \\ c)") == "[BO:<BO:<ID:a | ID:b> \\ ID:c>]"
+    assert parse("(a + b c * d e)") == "[BO:<ID:a + ID:b>, BO:<ID:c * ID:d>, ID:e]"
+    precedences = {"+": (130, Associativity.RIGHT), "**": (120, Associativity.LEFT)}
+    table = OperatorTable(precedences)
+    assert parse("(a + b + c ** d)", table) == "[BO:<BO:<ID:a + BO:<ID:b + ID:c>> ** ID:d>]"
+    assert parse("(a + b + c ** d)", precedences.get) == parse("(a + b + c ** d)", table)
+    assert parse("(a - b)", table) == parse("(a - b)")
+
+
+def test_include_includes(tmp_path):
+    (tmp_path / "a.mr").write_text('{$include "b.mr"}\nx\n{$include "b.mr"}')
+    (tmp_path / "b.mr").write_text('y {$include "sub/c.mr"}')
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "c.mr").write_text("z")
+    a = str(tmp_path / "a.mr")
+    for workers in (None, 2):
+        nodes = include_includes(a, cached_file_to_baseformat(a), workers)
+        assert [n.value for n in regular(nodes)] == ["y", "z", "x", "y", "z"]
+    b = cached_file_to_baseformat(str(tmp_path / "b.mr"))
+    assert b is cached_file_to_baseformat(str(tmp_path / "b.mr"))
+
+    # the included nodes are copies, which compiling may write to
+    first, second = [n for n in include_includes(a, cached_file_to_baseformat(a)) if getattr(n, "value", "") == "y"]
+    assert first == second == b[0] and first is not second and first is not b[0]
+    (tmp_path / "d.mr").write_text('{$include "e.mr"}')
+    (tmp_path / "e.mr").write_text('[1 /* c */ (2)] 2')
+    [sb, _, n] = include_includes(str(tmp_path / "d.mr"), cached_file_to_baseformat(str(tmp_path / "d.mr")))
+    [e_sb, _, e_n] = cached_file_to_baseformat(str(tmp_path / "e.mr"))
+    assert repr(sb) == repr(e_sb) and str(sb) == str(e_sb) and sb.start_pos() == e_sb.start_pos()
+    assert sb.nodes[-1] is sb._original_nodes[-1] and sb.nodes[-1] is not e_sb.nodes[-1]
+    n._type = "int"
+    assert e_n._type != "int"
+
+    (tmp_path / "sub" / "c.mr").write_text('{$include "../a.mr"}')
+    with pytest.raises(ParseError, match="Include cycle"):
+        include_includes(a, cached_file_to_baseformat(a))
+
+
+def test_e_string_parts():
+    [n] = regular(src_to_baseformat('\n  "a \\"{x}\\" {{g 2}}{[1]|sum}\nb"e'))
+    parts = e_string_parts(n)
+    assert [p if isinstance(p, str) else repr(p) for p in parts] == [
+        'a "', "RB:(ID:x)", '" ', "RB:(CB:{ID:g WS N:2})", "RB:(SB:[N:1] OP:| ID:sum)", "\nb"]
+    assert parts[1].start_pos() == (2, 8)
+    assert parts[3].nodes[0].start_pos() == (2, 15)
+
+
+def test_baseformat_cache(tmp_path):
+    def dump(ns):
+        return [(repr(n), n._start, n._end, n.start_pos(), dump(getattr(n, "nodes", [])),
+                 len(getattr(n, "_original_nodes", []))) for n in ns]
+
+    src = '{fun f [x] # c\n    "a{x}"e + 2k} ([]) {}'
+    parsed = src_to_baseformat(src, cache_dir=str(tmp_path))
+    [cache_file] = tmp_path.iterdir()
+    loaded = src_to_baseformat(src, cache_dir=str(tmp_path))
+    assert loaded is not parsed
+    assert dump(loaded) == dump(parsed) == dump(src_to_baseformat(src))
+
+    cache_file.write_bytes(b"garbage")
+    assert dump(src_to_baseformat(src, cache_dir=str(tmp_path))) == dump(parsed)
+
+    diag = Diagnostics()
+    src_to_baseformat("{a", diag, cache_dir=str(tmp_path))
+    assert diag.has_errors()
+    assert len(list(tmp_path.iterdir())) == 1
+
+    src += " # end"
+    parsed = src_to_baseformat(src, cache_dir=str(tmp_path), keep_trivia=False)
+    loaded = src_to_baseformat(src, cache_dir=str(tmp_path), keep_trivia=False)
+    assert loaded is not parsed
+    assert dump(loaded) == dump(parsed) == dump(src_to_baseformat(src, keep_trivia=False))
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_baseformat_cache_unwritable(tmp_path):
+    src = "{a [b]}"
+    not_a_dir = tmp_path / "file"
+    not_a_dir.write_text("")
+    assert repr(src_to_baseformat(src, cache_dir=str(not_a_dir / "cache"))) == repr(src_to_baseformat(src))
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    os.mkdir(_baseformat_cache.cache_path(src, str(cache_dir)))  # so the final rename fails
+    assert repr(src_to_baseformat(src, cache_dir=str(cache_dir))) == repr(src_to_baseformat(src))
+    assert [p.suffix for p in cache_dir.iterdir()] == [".mbf"]
+
+
+def test_keep_trivia():
+    src = '{a # c\n [b  c] /* d */}\n(e)'
+    with_trivia = src_to_baseformat(src)
+    [curly, round_] = src_to_baseformat(src, keep_trivia=False)
+    assert repr(curly) == "CB:{ID:a SB:[ID:b ID:c]}"
+    assert repr(round_) == repr(regular(with_trivia)[1])
+    assert (curly._start, curly._end, curly.nodes[1]._end) == (0, 23, 14)
+    assert curly._original_nodes == []
+    assert str(curly) == "{a [b c]}"
+    assert str(with_trivia[0]) == "{a # c\n [b  c] /* d */}"
+
+
+def test_file_to_baseformat_mmap(tmp_path):
+    path = tmp_path / "a.mr"
+    path.write_text('{a [b 2]} # c\n"d"', encoding="utf-8")
+    parsed = file_to_baseformat(str(path), mmap=True)
+    assert [(repr(n), n.start_pos(), str(n)) for n in parsed] == [
+        (repr(n), n.start_pos(), str(n)) for n in file_to_baseformat(str(path))]
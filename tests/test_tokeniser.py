@@ -1,6 +1,9 @@
 
-from makrell.ast import Identifier, LPar, Number, Operator, RPar, String, Unknown, Whitespace
-from makrell.tokeniser import regular, src_to_tokens
+import io
+from makrell.ast import Comment, Identifier, LPar, Number, Operator, RPar, String, Unknown, Whitespace
+from makrell.tokeniser import (
+    file_to_token_stream, file_to_tokens, iter_tokens, regular, retokenise, src_to_token_stream, src_to_tokens,
+    token_at)
 
 
 def test_minimal():
@@ -127,6 +130,22 @@ def test_unicode():
     assert tokens[8].value == "｢｣"
 
 
+def test_ascii_fast_path():
+    src = 'a_1 $x 2.5e-3k "s\\"t"dt -7 ->!|@ ^` ~'
+    kinds = [(type(t), str(t)) for t in src_to_tokens(src)]
+    assert [(type(t), str(t)) for t in src_to_tokens(src + " ø")][:-2] == kinds
+    assert [(type(t), str(t)) for t in src_to_token_stream(src.encode())] == kinds
+    assert kinds[-5:] == [(Operator, "->!|@"), (Whitespace, " "), (Unknown, "^`"), (Whitespace, " "), (Operator, "~")]
+
+
+def test_interned_values():
+    tokens = regular(src_to_tokens("fun" + " fun" * 3 + " = =" + ' "fun"'))
+    assert all(t.value is tokens[0].value for t in tokens[1:4])
+    assert tokens[4].value is tokens[5].value
+    stream = src_to_token_stream("x = x =").regular()
+    assert stream[0].value is stream[2].value and stream[1].value is stream[3].value
+
+
 def test_multiline():
     src = """2
     3
@@ -139,3 +158,139 @@ def test_multiline():
     assert tokens[1].value == "3"
     assert isinstance(tokens[2], Number)
     assert tokens[2].value == "5"
+
+
+def test_comments():
+    src = 'a # line\n/* block\n{x} */ "s\n"q 2.5e3k'
+    tokens = src_to_tokens(src)
+    assert [type(t).__name__ for t in tokens] == [
+        "Identifier", "Whitespace", "Comment", "Whitespace", "Comment",
+        "Whitespace", "String", "Whitespace", "Number"]
+    assert tokens[2].value == "# line"
+    assert tokens[4].value == "/* block\n{x} */"
+    assert tokens[6].value == '"s\n"'
+    assert tokens[6].suffix == "q"
+    assert tokens[8].value == "2.5e3"
+    assert tokens[8].suffix == "k"
+
+
+def test_positions():
+    src = "a\n  bc {d}"
+    tokens = regular(src_to_tokens(src))
+    assert [(t._start_line, t._start_column, t._end_line, t._end_column) for t in tokens] == [
+        (1, 1, 1, 2), (2, 3, 2, 5), (2, 6, 2, 7), (2, 7, 2, 8), (2, 8, 2, 9)]
+
+
+def test_unrecognized():
+    try:
+        src_to_tokens("a\n 'b")
+        assert False
+    except ValueError as e:
+        assert str(e) == "Unrecognized character sequence at 2:2"
+
+
+def test_iter_tokens():
+    src = 'a 2.5e-3 "asd\n{2}"e /* c\n */ -7 {b}\n# end ø æ'
+    expected = [(type(t), str(t), t._start_line, t._start_column) for t in src_to_tokens(src)]
+    for chunk_size in (1, 2, 3, 7, 1000):
+        tokens = iter_tokens(io.StringIO(src), chunk_size)
+        assert [(type(t), str(t), t._start_line, t._start_column) for t in tokens] == expected
+
+
+def test_keep_trivia():
+    src = 'a # c\n 2k "x"e /* d */ {b} ^'
+    tokens = src_to_tokens(src, keep_trivia=False)
+    assert [(type(t), str(t), t._start) for t in tokens] == [
+        (type(t), str(t), t._start) for t in regular(src_to_tokens(src))]
+    stream = src_to_token_stream(src, keep_trivia=False)
+    assert [(type(t), str(t), t._start) for t in stream] == [(type(t), str(t), t._start) for t in tokens]
+
+
+def test_token_stream():
+    src = 'a 2k "x"e {b} # c'
+    ts = src_to_token_stream(src)
+    tokens = src_to_tokens(src)
+    assert len(ts) == len(tokens)
+    assert [(type(t), t.value) for t in ts] == [(type(t), t.value) for t in tokens]
+    assert ts.value(2) == "2"
+    assert ts.suffix(2) == "k"
+    reg = regular(ts)
+    assert [t.value for t in reg] == ["a", "2", '"x"', "{", "b", "}"]
+    assert reg[4]._start_line == 1
+    assert reg[4]._start_column == 12
+
+
+def test_offsets():
+    src = 'a "x"q b\n  "y\nz"r c'
+    tokens = regular(src_to_tokens(src))
+    assert [(t._start, t._end) for t in tokens] == [(0, 1), (2, 6), (7, 8), (11, 17), (18, 19)]
+    assert [t.start_pos() for t in tokens] == [(1, 1), (1, 3), (1, 8), (2, 3), (3, 5)]
+    assert tokens[3].end_pos() == (3, 4)
+    assert tokens[4].pos_str() == "3:5"
+    lines = tokens[0]._lines
+    assert lines.offset(3, 5) == 18
+
+
+def test_token_at():
+    src = "ab {cd} ef"
+    tokens = src_to_tokens(src)
+    assert token_at(tokens, 0).value == "ab"
+    assert token_at(tokens, 1).value == "ab"
+    assert token_at(tokens, 2).value == " "
+    assert token_at(tokens, 5).value == "cd"
+    assert token_at(tokens, 10) is None
+
+
+def test_retokenise():
+    def key(tokens):
+        return [(type(t), t.value, t._start, t._end, t.start_pos()) for t in tokens]
+
+    src = 'a 12 "s" {b c}\nd e'
+    tokens = src_to_tokens(src)
+    edits = [
+        (4, 4, "3"),  # extend a number: a 123 "s"
+        (6, 9, '"x\ny"'),  # replace a string with a multiline one
+        (0, 0, "/*"),  # start a block comment
+        (0, 2, ""),  # and remove it again
+        (len(src) + 4, len(src) + 4, " f"),  # append
+    ]
+    for start, end, text in edits:
+        src = src[:start] + text + src[end:]
+        tokens = retokenise(tokens, src, start, end, start + len(text))
+        assert key(tokens) == key(src_to_tokens(src))
+
+    src = "/* a b c d e f g h"
+    tokens = retokenise(src_to_tokens(src), src + " */", len(src), len(src), len(src) + 3)
+    assert key(tokens) == key(src_to_tokens(src + " */"))
+    assert [type(t) for t in tokens] == [Comment]
+
+    # deleting the x joins * and / into the end of the comment
+    src = "/* a b c d e f g h *x/ i"
+    tokens = retokenise(src_to_tokens(src), src.replace("x", ""), 20, 21, 20)
+    assert key(tokens) == key(src_to_tokens(src.replace("x", "")))
+
+
+def test_file_to_token_stream(tmp_path):
+    def key(tokens):
+        return [(type(t), t.value, getattr(t, "suffix", None), t._start, t._end, t.start_pos()) for t in tokens]
+
+    for name, src in [("ascii.mr", 'a 2k\n  "x"e {b} # c\n'), ("unicode.mr", 'æ "ø"\n 七 2'),
+                      ("crlf.mr", 'a # c\r\n b\r"x"\r\n'), ("crlf_unicode.mr", 'æ # c\r\n ø\r\n')]:
+        path = tmp_path / name
+        path.write_bytes(src.encode("utf-8"))
+        tokens = file_to_tokens(str(path))
+        assert isinstance(tokens, list)
+        assert "\r" not in "".join(t.value for t in tokens)
+        with file_to_token_stream(str(path)) as stream:
+            assert key(stream) == key(tokens)
+
+    path = tmp_path / "empty.mr"
+    path.write_text("", encoding="utf-8")
+    assert len(file_to_token_stream(str(path))) == 0
+
+    # the mapping is closed with the stream, but nodes already made stay valid
+    path = tmp_path / "ascii.mr"
+    with file_to_token_stream(str(path)) as stream:
+        first = stream[0]
+    assert stream.src.closed
+    assert (first.value, first.start_pos()) == ("a", (1, 1))